@@ -18,9 +18,11 @@ import torch_geometric.utils as pyg_utils
 import torch_geometric.nn as pyg_nn
 from matplotlib import cm
 
+from common import canonical
 from common import data
 from common import models
 from common import utils
+from common.graph_store import GraphStore
 from subgraph_mining import decoder
 
 from tqdm import tqdm
@@ -67,9 +69,13 @@ def gen_baseline_queries(queries, targets, method="mfinder",
     if method == "mfinder":
         return utils.gen_baseline_queries_mfinder(queries, targets,
             node_anchored=node_anchored)
-    elif method == "rand-esu":
+    if method == "rand-esu":
+        if isinstance(targets, GraphStore):
+            targets = [targets.to_networkx(i) for i in range(len(targets))]
         return utils.gen_baseline_queries_rand_esu(queries, targets,
             node_anchored=node_anchored)
+    store = (targets if isinstance(targets, GraphStore) else
+        GraphStore.from_networkx(targets))
     neighs = []
     for i, query in enumerate(queries):
         print(i)
@@ -79,12 +85,11 @@ def gen_baseline_queries(queries, targets, method="mfinder",
             found = True
         while not found:
             if method == "radial":
-                graph = random.choice(targets)
-                node = random.choice(list(graph.nodes))
-                neigh = list(nx.single_source_shortest_path_length(graph, node,
-                    cutoff=3).keys())
+                graph_idx = random.randrange(len(store))
+                node = random.randrange(store.num_nodes(graph_idx))
+                neigh = store.ball(graph_idx, node, 3)
                 #neigh = random.sample(neigh, min(len(neigh), 15))
-                neigh = graph.subgraph(neigh)
+                neigh = store.to_networkx(graph_idx, neigh)
                 neigh = neigh.subgraph(list(sorted(nx.connected_components(
                     neigh), key=len))[-1])
                 neigh = nx.convert_node_labels_to_integers(neigh)
@@ -94,25 +99,36 @@ def gen_baseline_queries(queries, targets, method="mfinder",
                     found = True
             elif method == "tree":
                 # https://academic.oup.com/bioinformatics/article/20/11/1746/300212
-                graph = random.choice(targets)
-                start_node = random.choice(list(graph.nodes))
-                neigh = [start_node]
-                frontier = list(set(graph.neighbors(start_node)) - set(neigh))
-                while len(neigh) < len(query) and frontier:
-                    new_node = random.choice(list(frontier))
-                    assert new_node not in neigh
-                    neigh.append(new_node)
-                    frontier += list(graph.neighbors(new_node))
-                    frontier = [x for x in frontier if x not in neigh]
+                graph_idx = random.randrange(len(store))
+                start_node = random.randrange(store.num_nodes(graph_idx))
+                neigh = store.grow_neigh(graph_idx, start_node, len(query))
                 if len(neigh) == len(query):
-                    neigh = graph.subgraph(neigh)
-                    neigh = nx.convert_node_labels_to_integers(neigh)
-                    neighs.append(neigh)
+                    neighs.append(store.to_networkx(graph_idx, neigh))
                     found = True
     return neighs
 
+# targets of count_graphlets given as a GraphStore, opened once per worker
+target_store = None
+
+def open_target_store(store):
+    """Pool initializer: store is the GraphStore, or its path if it was
+    loaded from disk, which is then memory-mapped."""
+    global target_store
+    target_store = (GraphStore.load(store, mmap_mode="r") if
+        isinstance(store, str) else store)
+
 def count_graphlets_helper(inp):
     i, query, target, method, node_anchored, anchor_or_none = inp
+    if isinstance(target, int):
+        # index into target_store: an anchored match lies within len(query)-1
+        # hops of its anchor, so only that ball needs to be searched
+        if anchor_or_none is not None and any(a.get("anchor", 0) for _, a in
+            query.nodes(data=True)):
+            ball = target_store.ball(target, anchor_or_none, len(query) - 1)
+            target = target_store.to_networkx(target, ball)
+            anchor_or_none = 0
+        else:
+            target = target_store.to_networkx(target)
     # NOTE: removing self loops!!
     query = query.copy()
     query.remove_edges_from(nx.selfloop_edges(query))
@@ -169,11 +185,24 @@ def count_graphlets(queries, targets, n_workers=1, method="bin",
 
     n_matches = defaultdict(float)
     #for i, query in enumerate(queries):
-    pool = Pool(processes=n_workers)
+    if isinstance(targets, GraphStore):
+        # workers read the store instead of being sent a copy of each target
+        # graph, memory-mapped if it was loaded from disk (a store built in
+        # memory is sent once per worker); targets are passed as graph
+        # indices
+        pool = Pool(processes=n_workers, initializer=open_target_store,
+            initargs=(targets.path if targets.path is not None else targets,))
+        target_nodes = [range(targets.num_nodes(j)) for j in
+            range(len(targets))]
+        targets = list(range(len(targets)))
+    else:
+        pool = Pool(processes=n_workers)
+        target_nodes = targets
     if node_anchored:
         inp = [(i, query, target, method, node_anchored, anchor) for i, query
-            in enumerate(queries) for target in targets for anchor in (target
-                if len(targets) < 10 else [None])]
+            in enumerate(queries) for target, nodes in zip(targets,
+                target_nodes) for anchor in (nodes if len(targets) < 10 else
+                [None])]
     else:
         inp = [(i, query, target, method, node_anchored, None) for i, query
             in enumerate(queries) for target in targets]
@@ -191,7 +220,8 @@ def count_exact(queries, targets, args):
     print("WARNING: orca only works for node anchored")
     # TODO: non node anchored
     n_matches_baseline = np.zeros(73)
-    for target in targets:
+    for target in (targets if not isinstance(targets, GraphStore) else
+        (targets.to_networkx(i) for i in range(len(targets)))):
         counts = np.array(orca.orbit_counts("node", 5, target))
         if args.count_method == "bin":
             counts = np.sign(counts)
@@ -214,14 +244,8 @@ def count_exact(queries, targets, args):
             g = g.copy()
             nx.set_node_attributes(g, 0, name="anchor")
             g.nodes[v]["anchor"] = 1
-            is_dup = False
-            for g2 in queries:
-                if nx.is_isomorphic(g, g2, node_match=(lambda a, b: a["anchor"]
-                    == b["anchor"]) if args.node_anchored else None):
-                    is_dup = True
-                    break
-            if not is_dup:
-                queries.append(g)
+            queries.append(g)
+    queries = canonical.dedupe(queries, node_anchored=args.node_anchored)
     print(len(queries))
     n_matches_baseline = count_graphlets(queries, targets,
         n_workers=args.n_workers, method=args.count_method,
@@ -240,33 +264,16 @@ if __name__ == "__main__":
     print("Using {} workers".format(args.n_workers))
     print("Baseline:", args.baseline)
 
-    if args.dataset == 'enzymes':
-        dataset = TUDataset(root='/tmp/ENZYMES', name='ENZYMES')
-    elif args.dataset == 'cox2':
-        dataset = TUDataset(root='/tmp/cox2', name='COX2')
-    elif args.dataset == 'reddit-binary':
-        dataset = TUDataset(root='/tmp/REDDIT-BINARY', name='REDDIT-BINARY')
-    elif args.dataset == 'coil':
-        dataset = TUDataset(root='/tmp/COIL-DEL', name='COIL-DEL')
+    if args.dataset in ['enzymes', 'cox2', 'reddit-binary', 'coil']:
+        dataset = data.load_graphs(args.dataset)
     elif args.dataset == 'ppi-pathways':
-        graph = nx.Graph()
-        with open("data/ppi-pathways.csv", "r") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                graph.add_edge(int(row[0]), int(row[1]))
-        dataset = [graph]
+        dataset = data.load_edge_list("data/ppi-pathways.csv", delimiter=",")
     elif args.dataset in ['diseasome', 'usroads', 'mn-roads', 'infect']:
         fn = {"diseasome": "bio-diseasome.mtx",
             "usroads": "road-usroads.mtx",
             "mn-roads": "mn-roads.mtx",
             "infect": "infect-dublin.edges"}
-        graph = nx.Graph()
-        with open("data/{}".format(fn[args.dataset]), "r") as f:
-            for line in f:
-                if not line.strip(): continue
-                a, b = line.strip().split(" ")
-                graph.add_edge(int(a), int(b))
-        dataset = [graph]
+        dataset = data.load_edge_list("data/{}".format(fn[args.dataset]))
     elif args.dataset.startswith('plant-'):
         size = int(args.dataset.split("-")[-1])
         dataset = decoder.make_plant_dataset(size)
@@ -274,25 +281,24 @@ if __name__ == "__main__":
         with open("results/analyze.p", "rb") as f:
             cand_patterns, _ = pickle.load(f)
             queries = [q for score, q in cand_patterns[10]][:200]
-        dataset = TUDataset(root='/tmp/ENZYMES', name='ENZYMES')
+        dataset = data.load_graphs('enzymes')
 
-    targets = []
-    for i in range(len(dataset)):
-        graph = dataset[i]
-        if not type(graph) == nx.Graph:
-            graph = pyg_utils.to_networkx(dataset[i]).to_undirected()
-        targets.append(graph)
+    if isinstance(dataset, GraphStore):
+        targets = dataset
+    else:
+        targets = []
+        for i in range(len(dataset)):
+            graph = dataset[i]
+            if not type(graph) == nx.Graph:
+                graph = pyg_utils.to_networkx(dataset[i]).to_undirected()
+            targets.append(graph)
 
     if args.dataset != "analyze":
         with open(args.queries_path, "rb") as f:
             queries = pickle.load(f)
 
     # filter only top nonisomorphic size 6 motifs
-    #filt_q = []
-    #for q in queries:
-    #    if len([qc for qc in filt_q if nx.is_isomorphic(q, qc)]) == 0:
-    #        filt_q.append(q)
-    #queries = filt_q[:]
+    #queries = canonical.dedupe(queries)
     #print(len(queries))
             
     query_lens = [len(query) for query in queries]
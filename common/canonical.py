@@ -0,0 +1,149 @@
+"""Exact canonical forms of small graphs, for deduplicating patterns.
+
+canonical_key(g) is equal for two graphs exactly when they are isomorphic
+(respecting the anchor node if node_anchored). It is computed by
+individualization-refinement: nodes are colored by color refinement, then a
+search tree individualizes the nodes of the first non-singleton color cell
+one at a time and refines again, until every node has its own color. Each
+leaf orders the nodes, and the key is the smallest edge list over the
+leaves. Subtrees known to be equivalent under an automorphism found at an
+earlier leaf are skipped: children in the same orbit under the automorphisms
+fixing their parent's individualized nodes are searched once, and when a
+leaf repeats an earlier leaf's certificate the search backjumps to where the
+two paths diverge, as in nauty.
+
+The search is exponential in the worst case but fast on the pattern sizes
+the miner outputs.
+"""
+from collections import defaultdict
+import functools
+
+CANONICAL_CACHE_SIZE = 2**16
+
+def refine(colors, adj):
+    """Coarsest equitable refinement of the coloring colors (list of ints)
+    on adjacency lists adj. New colors are ranks of (color, sorted neighbor
+    colors) signatures, so the result does not depend on node ids."""
+    n_colors = len(set(colors))
+    while True:
+        sigs = [(colors[v], tuple(sorted(colors[u] for u in adj[v]))) for v in
+            range(len(adj))]
+        rank = {sig: i for i, sig in enumerate(sorted(set(sigs)))}
+        colors = [rank[sig] for sig in sigs]
+        if len(rank) == n_colors:
+            return colors
+        n_colors = len(rank)
+
+def individualize(colors, v):
+    """Gives v a color of its own, ordered just before its former cell."""
+    return [2*c + (u != v) if c == colors[v] else 2*c + 1 for u, c in
+        enumerate(colors)]
+
+def certificate(colors, edges, anchors):
+    return (tuple(sorted(tuple(sorted((colors[u], colors[v]))) for u, v in
+        edges)), tuple(sorted(colors[v] for v in anchors)))
+
+class _Search:
+    def __init__(self, n, edges, anchors):
+        self.n, self.edges, self.anchors = n, edges, anchors
+        self.adj = [[] for _ in range(n)]
+        for u, v in edges:
+            self.adj[u].append(v)
+            if u != v:
+                self.adj[v].append(u)
+        self.best = None
+        # certificate -> (coloring, individualized nodes) of its first leaf
+        self.leaves = {}
+        # automorphisms found so far, as node maps
+        self.automorphisms = []
+
+    def run(self):
+        colors = [int(v in self.anchors) for v in range(self.n)]
+        self.search(refine(colors, self.adj), [])
+        return self.best
+
+    def orbits(self, cell, fixed):
+        """Map from each node of cell to a representative of its orbit under
+        the automorphisms found so far that fix every node of fixed."""
+        parent = {v: v for v in cell}
+        def find(v):
+            while parent[v] != v:
+                v = parent[v]
+            return v
+        for gamma in self.automorphisms:
+            if any(gamma[v] != v for v in fixed): continue
+            for v in cell:
+                a, b = find(v), find(gamma[v])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        return {v: find(v) for v in cell}
+
+    def search(self, colors, fixed):
+        """Searches the subtree of the node that individualized the nodes
+        fixed. Returns None, or the depth to backjump to."""
+        cells = defaultdict(list)
+        for v, c in enumerate(colors):
+            cells[c].append(v)
+        targets = [c for c in sorted(cells) if len(cells[c]) > 1]
+        if not targets:
+            cert = certificate(colors, self.edges, self.anchors)
+            if cert in self.leaves:
+                # two leaves with the same certificate differ by an
+                # automorphism mapping one node order onto the other
+                other, other_fixed = self.leaves[cert]
+                pos = {c: v for v, c in enumerate(colors)}
+                self.automorphisms.append([pos[c] for c in other])
+                # it fixes the common prefix of the two paths, so the subtree
+                # below where they diverge is the image of one already
+                # searched
+                depth = 0
+                while (depth < min(len(fixed), len(other_fixed)) and
+                    fixed[depth] == other_fixed[depth]):
+                    depth += 1
+                return depth
+            self.leaves[cert] = (colors, fixed)
+            if self.best is None or cert < self.best:
+                self.best = cert
+            return None
+        cell = cells[targets[0]]
+        explored = []
+        for v in cell:
+            # children in the orbit of an explored child give the same leaves
+            orbit = self.orbits(cell, fixed)
+            if any(orbit[u] == orbit[v] for u in explored): continue
+            explored.append(v)
+            jump = self.search(refine(individualize(colors, v), self.adj),
+                fixed + [v])
+            if jump is not None and jump < len(fixed):
+                return jump
+        return None
+
+@functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonical_key_edges(n, edges, anchors=frozenset()):
+    """canonical_key of the graph on nodes 0 .. n-1 with edges, a sorted
+    tuple of (u, v) pairs listing each edge once, anchored at the nodes in
+    the frozenset anchors."""
+    return (n,) + _Search(n, edges, anchors).run()
+
+def canonical_key(g, node_anchored=False):
+    """Hashable key of g that is equal for two graphs iff they are isomorphic.
+    With node_anchored, nodes whose "anchor" attribute is 1 must map onto
+    each other."""
+    idx = {v: i for i, v in enumerate(g.nodes)}
+    edges = tuple(sorted((idx[u], idx[v]) for u, v in g.edges))
+    anchors = (frozenset(idx[v] for v, a in g.nodes(data="anchor") if a == 1)
+        if node_anchored else frozenset())
+    return canonical_key_edges(len(g), edges, anchors)
+
+def group_isomorphic(graphs, node_anchored=False):
+    """Lists of the graphs in each isomorphism class, in order of first
+    appearance."""
+    groups = defaultdict(list)
+    for graph in graphs:
+        groups[canonical_key(graph, node_anchored=node_anchored)].append(graph)
+    return list(groups.values())
+
+def dedupe(graphs, node_anchored=False):
+    """The first graph of each isomorphism class, in order."""
+    return [group[0] for group in group_isomorphic(graphs,
+        node_anchored=node_anchored)]
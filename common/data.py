@@ -1,11 +1,14 @@
+import hashlib
 import os
 import pickle
 import random
+import shutil
 
 from deepsnap.graph import Graph as DSGraph
 from deepsnap.batch import Batch
 from deepsnap.dataset import GraphDataset, Generator
 import networkx as nx
+import networkx.algorithms.isomorphism as iso
 import numpy as np
 from sklearn.manifold import TSNE
 import torch
@@ -13,6 +16,7 @@ import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torch.optim as optim
 from torch_geometric.data import DataLoader
+from torch_geometric.data import Batch as PyGBatch
 from torch.utils.data import DataLoader as TorchDataLoader
 from torch_geometric.datasets import TUDataset, PPI, QM9
 import torch_geometric.utils as pyg_utils
@@ -24,13 +28,19 @@ import scipy.stats as stats
 from common import combined_syn
 from common import feature_preprocess
 from common import utils
+from common.graph_store import GraphStore
+from common.label_store import LabelStore
 
-def load_dataset(name):
-    """ Load real-world datasets, available in PyTorch Geometric.
+# bump when the conversion in load_graphs changes, to invalidate old caches
+DATASET_CACHE_VERSION = 1
+DATASET_CACHE_DIR = "data/cache/datasets"
+# seconds gen_batches waits for a batch before checking on its workers
+WORKER_POLL_TIMEOUT = 10
 
-    Used as a helper for DiskDataSource.
+def load_raw_dataset(name):
+    """ Real-world dataset by name, as downloaded by PyTorch Geometric (or a
+    list of networkx graphs).
     """
-    task = "graph"
     if name == "enzymes":
         dataset = TUDataset(root="/tmp/ENZYMES", name="ENZYMES")
     elif name == "proteins":
@@ -47,32 +57,360 @@ def load_dataset(name):
         dataset = TUDataset(root="/tmp/FIRSTMM_DB", name="FIRSTMM_DB")
     elif name == "dblp":
         dataset = TUDataset(root="/tmp/DBLP_v1", name="DBLP_v1")
+    elif name == "coil":
+        dataset = TUDataset(root="/tmp/COIL-DEL", name="COIL-DEL")
     elif name == "ppi":
         dataset = PPI(root="/tmp/PPI")
     elif name == "qm9":
         dataset = QM9(root="/tmp/QM9")
     elif name == "atlas":
         dataset = [g for g in nx.graph_atlas_g()[1:] if nx.is_connected(g)]
-    if task == "graph":
-        train_len = int(0.8 * len(dataset))
-        train, test = [], []
-        dataset = list(dataset)
-        random.shuffle(dataset)
+    else:
+        raise ValueError("unknown dataset {}".format(name))
+    return dataset
+
+def load_graph_store(name):
+    """ Graphs of a real-world dataset as a GraphStore, in dataset order.
+
+    The converted graphs are cached under DATASET_CACHE_DIR, so only the
+    first run pays for the conversion from PyTorch Geometric.
+    """
+    path = os.path.join(DATASET_CACHE_DIR, "{}-v{}".format(name,
+        DATASET_CACHE_VERSION))
+    if os.path.exists(os.path.join(path, "node_offsets.npy")):
+        store = GraphStore.load(path)
+    else:
+        dataset = list(load_raw_dataset(name))
         has_name = hasattr(dataset[0], "name")
-        for i, graph in tqdm(enumerate(dataset)):
+        graphs = []
+        for graph in tqdm(dataset):
             if not type(graph) == nx.Graph:
                 if has_name: del graph.name
                 graph = pyg_utils.to_networkx(graph).to_undirected()
-            if i < train_len:
-                train.append(graph)
-            else:
-                test.append(graph)
-    return train, test, task
+            graphs.append(graph)
+        store = GraphStore.from_networkx(graphs)
+        store.save(path)
+        print("saved", path)
+    return store
+
+def load_graphs(name):
+    """ Graphs of a real-world dataset as undirected networkx graphs, in
+    dataset order, with nodes numbered 0 .. n-1 (see load_graph_store).
+    """
+    store = load_graph_store(name)
+    return [store.to_networkx(i) for i in range(len(store))]
+
+GRAPH_CACHE_DIR = "data/cache/graphs"
+
+def load_edge_list(path, delimiter=None):
+    """ Single large graph stored as a text edge list (see
+    GraphStore.from_edge_list), as a read-only memory-mapped GraphStore.
+
+    The edge list is converted once to CSR arrays under GRAPH_CACHE_DIR; all
+    processes that load the same file share one copy of it in memory.
+    """
+    out_path = os.path.join(GRAPH_CACHE_DIR, "{}-v{}".format(
+        os.path.basename(path), DATASET_CACHE_VERSION))
+    if not os.path.exists(os.path.join(out_path, "node_offsets.npy")):
+        print("converting", path)
+        GraphStore.from_edge_list(path, delimiter=delimiter).save(out_path)
+        print("saved", out_path)
+    return GraphStore.load(out_path, mmap_mode="r")
+
+def split_dataset(n_graphs, seed=None):
+    """ Indices of the train and test graphs of a dataset of n_graphs graphs:
+    they are shuffled (with a random.Random(seed) if seed is given) and split
+    80/20.
+    """
+    idxs = list(range(n_graphs))
+    if seed is None:
+        random.shuffle(idxs)
+    else:
+        random.Random(seed).shuffle(idxs)
+    train_len = int(0.8 * n_graphs)
+    return idxs[:train_len], idxs[train_len:]
+
+def load_dataset(name, seed=None):
+    """ Load real-world datasets, available in PyTorch Geometric, as lists of
+    networkx graphs split into train and test (see split_dataset).
+    """
+    task = "graph"
+    store = load_graph_store(name)
+    train, test = split_dataset(len(store), seed=seed)
+    return ([store.to_networkx(i) for i in train], [store.to_networkx(i) for i
+        in test], task)
+
+def load_dataset_stores(name, seed=None):
+    """ load_dataset as train and test GraphStores, sliced from the cached
+    store of the dataset. Used as a helper for DiskDataSource.
+    """
+    store = load_graph_store(name)
+    train, test = split_dataset(len(store), seed=seed)
+    return store.subset(train), store.subset(test)
+
+# collated validation sets, see save_batches
+VAL_CACHE_VERSION = 2
+VAL_CACHE_DIR = "data/cache/val"
+
+# sampled decoder neighborhoods and their embeddings, see
+# NeighborhoodWriter
+NEIGH_CACHE_VERSION = 3
+NEIGH_CACHE_DIR = "data/cache/neighborhoods"
+
+def file_hash(path):
+    """sha1 of the contents of file path."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def save_arrays(path, arrays):
+    """ Saves the numpy arrays of dict arrays as <key>.npy files in a new
+    directory path. They are written to a temporary directory that is moved
+    into place at the end, so path is either complete or missing, even if
+    the process dies midway or another process saves the same arrays.
+    """
+    tmp = "{}.tmp-{}".format(path, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for key, arr in arrays.items():
+        np.save(os.path.join(tmp, key + ".npy"), arr)
+    move_into_place(tmp, path)
+
+def move_into_place(tmp, path):
+    """ Renames directory tmp to path, or deletes it if another process
+    created path in the meantime.
+    """
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+
+class NeighborhoodWriter:
+    """ Writes (n_nodes, edge_index) neighborhoods (see
+    graph_store.radial_chunk) to a neighborhood store in directory path as
+    they are produced, then their embeddings. The neighborhoods are appended
+    to flat int64 files, so they never have to be in memory all at once. The
+    store is built in a temporary directory that close moves to path, so an
+    interrupted run leaves no store behind.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp = "{}.tmp-{}".format(path, os.getpid())
+        if os.path.exists(self.tmp):
+            shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+        self.files = {key: open(os.path.join(self.tmp, key + ".bin"), "wb")
+            for key in ["n_nodes", "edge_counts", "edge_index"]}
+
+    def add(self, neighs):
+        """ Appends a chunk of neighborhoods. """
+        self.files["n_nodes"].write(np.array([n for n, _ in neighs],
+            dtype=np.int64).tobytes())
+        self.files["edge_counts"].write(np.array([e.shape[1] for _, e in
+            neighs], dtype=np.int64).tobytes())
+        for _, edge_index in neighs:
+            # as (n_edges, 2) rows, so that chunks can be appended
+            self.files["edge_index"].write(np.ascontiguousarray(
+                edge_index.T, dtype=np.int64).tobytes())
+
+    def close(self, embs):
+        """ Saves the embeddings of all the neighborhoods, a numpy array whose
+        dtype is kept, and moves the store into place. """
+        for f in self.files.values():
+            f.close()
+        np.save(os.path.join(self.tmp, "emb.npy"), embs)
+        move_into_place(self.tmp, self.path)
+
+def load_neighborhoods(path):
+    """ Loads a store written by NeighborhoodWriter, or returns None if there
+    is none at path. The arrays are memory-mapped.
+
+    Returns: (n_nodes, edge_counts, edge_index, emb) arrays, with the
+        neighborhoods' edge_index arrays concatenated into a (2, E) array.
+    """
+    if not os.path.exists(os.path.join(path, "emb.npy")):
+        return None
+    def load_flat(key):
+        name = os.path.join(path, key + ".bin")
+        # empty files cannot be memory-mapped
+        if os.path.getsize(name) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.memmap(name, dtype=np.int64, mode="r")
+    return (load_flat("n_nodes"), load_flat("edge_counts"),
+        load_flat("edge_index").reshape(-1, 2).T, np.load(os.path.join(path,
+        "emb.npy"), mmap_mode="r"))
+
+def save_batches(path, batches):
+    """ Saves tuples of batches from batch_nx_graphs (or empty lists, for
+    missing positives) as flat arrays in directory path (see save_arrays).
+    Only the structure and anchors are kept, so batches with node features
+    are not supported.
+    """
+    sizes, node_graph, edge_index, anchor = [], [], [], []
+    for batch in [b for tup in batches for b in tup]:
+        if not batch:
+            sizes.append((0, 0, 0))
+            continue
+        n_graphs = batch.num_graphs
+        sizes.append((n_graphs, batch.batch.size(0), batch.edge_index.size(1)))
+        node_graph.append(batch.batch.cpu().numpy())
+        # flattened per batch, so each batch's edge_index is one contiguous
+        # block of the saved array
+        edge_index.append(batch.edge_index.cpu().numpy().reshape(-1))
+        anchor.append(batch.anchor.cpu().numpy() if getattr(batch, "anchor",
+            None) is not None else -np.ones(n_graphs, dtype=np.int64))
+    arrays = {"sizes": np.array(sizes, dtype=np.int64).reshape(-1, 3),
+        "tuple_len": np.array([len(batches[0]) if batches else 0]),
+        "batch": np.concatenate(node_graph or [np.zeros(0, dtype=np.int64)]),
+        "edge_index": np.concatenate(edge_index or [np.zeros(0,
+            dtype=np.int64)]),
+        "anchor": np.concatenate(anchor or [np.zeros(0, dtype=np.int64)])}
+    save_arrays(path, {key: arr.astype(np.int64) for key, arr in
+        arrays.items()})
+
+def load_batches(path):
+    """ Loads batches written by save_batches. The tensors are backed by
+    copy-on-write memory maps of the saved arrays.
+    """
+    arrays = {key: np.load(os.path.join(path, key + ".npy"), mmap_mode="c")
+        for key in ["sizes", "tuple_len", "batch", "edge_index", "anchor"]}
+    batches = []
+    node_start, edge_start, graph_start = 0, 0, 0
+    for n_graphs, n_nodes, n_edges in arrays["sizes"].tolist():
+        if n_graphs == 0:
+            batches.append([])
+            continue
+        node_graph = torch.from_numpy(arrays["batch"][node_start:node_start +
+            n_nodes])
+        edge_index = torch.from_numpy(arrays["edge_index"][2*edge_start:
+            2*(edge_start + n_edges)].reshape(2, n_edges))
+        anchor = torch.from_numpy(arrays["anchor"][graph_start:graph_start +
+            n_graphs])
+        batch = PyGBatch(batch=node_graph, edge_index=edge_index)
+        if anchor[0] >= 0:
+            batch.anchor = anchor
+        # networkx graphs for inspection, with node i at position i
+        starts = np.cumsum([0] + np.bincount(node_graph.numpy(),
+            minlength=n_graphs).tolist())
+        graph_of_edge = node_graph[edge_index[0]].numpy()
+        batch.G = []
+        for i in range(n_graphs):
+            graph = nx.Graph()
+            graph.add_nodes_from(range(starts[i+1] - starts[i]))
+            edges = edge_index[:, graph_of_edge == i].numpy() - starts[i]
+            graph.add_edges_from(zip(edges[0].tolist(), edges[1].tolist()))
+            batch.G.append(graph)
+        batches.append(batch)
+        node_start += n_nodes
+        edge_start += n_edges
+        graph_start += n_graphs
+    tuple_len = int(arrays["tuple_len"][0])
+    if tuple_len == 0:
+        return []
+    return [tuple(batches[i:i+tuple_len]) for i in range(0, len(batches),
+        tuple_len)]
+
+# ground-truth labels of the imbalanced data sources
+LABEL_STORE_PATH = "data/cache/labels.db"
+LABEL_TIMEOUT = 10 # seconds per pair; pairs that time out are dropped
+
+def add_anchor(g):
+    """ Marks a random node of g as its anchor, through the integer "anchor"
+    node attribute (1 at the anchor, 0 elsewhere).
+    """
+    anchor = random.choice(list(g.nodes))
+    for v in g.nodes:
+        g.nodes[v]["anchor"] = int(v == anchor)
+    return anchor
+
+def batch_anchored_graphs(graphs):
+    """ batch_nx_graphs for graphs anchored by add_anchor. Graphs without the
+    "anchor" attribute (unanchored) are batched as is.
+    """
+    if graphs and "anchor" in graphs[0].nodes[next(iter(graphs[0].nodes))]:
+        anchors = [next(v for v in g.nodes if g.nodes[v]["anchor"]) for g in
+            graphs]
+        return utils.batch_nx_graphs(graphs, anchors=anchors)
+    return utils.batch_nx_graphs(graphs)
+
+def split_by_label(label_store, graphs_a, graphs_b, node_anchored):
+    """ Splits the pairs (graphs_a[i], graphs_b[i]) into positive (graphs_b[i]
+    is a subgraph of graphs_a[i]) and negative pairs, using label_store.
+    Pairs whose label timed out are left out.
+
+    Returns: pos_a, pos_b, neg_a, neg_b
+    """
+    pos_a, pos_b, neg_a, neg_b = [], [], [], []
+    labels = label_store.label(graphs_a, graphs_b, node_anchored)
+    for graph_a, graph_b, label in zip(graphs_a, graphs_b, labels):
+        if label is None: continue
+        if label:
+            pos_a.append(graph_a)
+            pos_b.append(graph_b)
+        else:
+            neg_a.append(graph_a)
+            neg_b.append(graph_b)
+    return pos_a, pos_b, neg_a, neg_b
 
 class DataSource:
-    def gen_batch(batch_target, batch_neg_target, batch_neg_query, train):
+    def gen_batch(self, batch_target, batch_neg_target, batch_neg_query,
+        train):
         raise NotImplementedError
 
+    def close(self):
+        """ Releases the resources held by the source between batches, such
+        as label store connections. They are reopened on next use.
+        """
+        pass
+
+    def gen_batches(self, size, batch_size, train=True):
+        """ Yields size // batch_size batches (pos_a, pos_b, neg_a, neg_b),
+        generated in the calling process.
+        """
+        loaders = self.gen_data_loaders(size, batch_size, train=train)
+        for batch_target, batch_neg_target, batch_neg_query in zip(*loaders):
+            yield self.gen_batch(batch_target, batch_neg_target,
+                batch_neg_query, train)
+
+def produce_batches(data_source, n_batches, batch_size, train, out_queue):
+    """ Worker loop for OTFSynDataSource.gen_batches: generates n_batches
+    batches on the CPU and puts them, pickled, on out_queue.
+    """
+    # keep generated batches on the CPU; the consumer moves them to its device
+    utils.device_cache = torch.device("cpu")
+    # fresh seeds per worker: spawned workers (as in train.main) already
+    # get them, but forked ones would all start from the parent's RNG state
+    random.seed()
+    np.random.seed()
+    for batch in DataSource.gen_batches(data_source, n_batches * batch_size,
+        batch_size, train=train):
+        # pickled by value: sharing every small tensor of a batch through
+        # torch.multiprocessing would use one file descriptor per tensor
+        out_queue.put(pickle.dumps(batch))
+
+def next_batch(out_queue, workers):
+    """Next item of out_queue, raising if the workers feeding it have died
+    (or all finished) so that none can come."""
+    while True:
+        try:
+            return out_queue.get(timeout=WORKER_POLL_TIMEOUT)
+        except queue.Empty:
+            for worker in workers:
+                if worker.exitcode not in [None, 0]:
+                    raise RuntimeError("batch worker {} exited with code "
+                        "{}".format(worker.pid, worker.exitcode))
+            if all(worker.exitcode == 0 for worker in workers):
+                # items put just before exiting may have arrived since the
+                # timeout
+                try:
+                    return out_queue.get_nowait()
+                except queue.Empty:
+                    raise RuntimeError("batch workers exited before "
+                        "producing all batches")
+
 class OTFSynDataSource(DataSource):
     """ On-the-fly generated synthetic data for training the subgraph model.
 
@@ -80,12 +418,18 @@ class OTFSynDataSource(DataSource):
     with a pre-defined generator (see combined_syn.py).
 
     DeepSNAP transforms are used to generate the positive and negative examples.
+
+    gen_batches runs gen_batch in n_workers background processes, which feed
+    ready batches through a queue holding at most max_queue_size batches
+    (n_workers=0 generates batches inline).
     """
     def __init__(self, max_size=29, min_size=5, n_workers=4,
         max_queue_size=256, node_anchored=False):
         self.closed = False
         self.max_size = max_size
         self.min_size = min_size
+        self.n_workers = n_workers
+        self.max_queue_size = max_queue_size
         self.node_anchored = node_anchored
         self.generator = combined_syn.get_generator(np.arange(
             self.min_size + 1, self.max_size + 1))
@@ -106,48 +450,72 @@ class OTFSynDataSource(DataSource):
         loaders.append([None]*(size // batch_size))
         return loaders
 
+    def gen_batches(self, size, batch_size, train=True):
+        """ Yields size // batch_size batches (pos_a, pos_b, neg_a, neg_b),
+        generated by background worker processes. Batches are on the CPU.
+        """
+        if self.n_workers == 0:
+            yield from super().gen_batches(size, batch_size, train=train)
+            return
+        n_batches = size // batch_size
+        out_queue = mp.Queue(maxsize=self.max_queue_size)
+        workers = []
+        for i in range(self.n_workers):
+            n = n_batches // self.n_workers + int(i < n_batches %
+                self.n_workers)
+            worker = mp.Process(target=produce_batches, args=(self, n,
+                batch_size, train, out_queue))
+            worker.start()
+            workers.append(worker)
+        try:
+            for i in range(n_batches):
+                yield pickle.loads(next_batch(out_queue, workers))
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
     def gen_batch(self, batch_target, batch_neg_target, batch_neg_query,
         train):
         def sample_subgraph(graph, offset=0, use_precomp_sizes=False,
             filter_negs=False, supersample_small_graphs=False, neg_target=None,
             hard_neg_idxs=None):
-            if neg_target is not None: graph_idx = graph.G.graph["idx"]
-            use_hard_neg = (hard_neg_idxs is not None and graph.G.graph["idx"]
+            """ Returns a subgraph of graph, the node it was grown from (the
+            anchor in graph) and the anchor of the subgraph.
+            """
+            if neg_target is not None: graph_idx = graph.graph["idx"]
+            use_hard_neg = (hard_neg_idxs is not None and graph.graph["idx"]
                 in hard_neg_idxs)
             done = False
             n_tries = 0
             while not done:
                 if use_precomp_sizes:
-                    size = graph.G.graph["subgraph_size"]
+                    size = graph.graph["subgraph_size"]
                 else:
                     if train and supersample_small_graphs:
                         sizes = np.arange(self.min_size + offset,
-                            len(graph.G) + offset)
+                            len(graph) + offset)
                         ps = (sizes - self.min_size + 2) ** (-1.1)
                         ps /= ps.sum()
                         size = stats.rv_discrete(values=(sizes, ps)).rvs()
                     else:
                         d = 1 if train else 0
                         size = random.randint(self.min_size + offset - d,
-                            len(graph.G) - 1 + offset)
-                start_node = random.choice(list(graph.G.nodes))
+                            len(graph) - 1 + offset)
+                start_node = random.choice(list(graph.nodes))
                 neigh = [start_node]
-                frontier = list(set(graph.G.neighbors(start_node)) - set(neigh))
+                frontier = list(set(graph.neighbors(start_node)) - set(neigh))
                 visited = set([start_node])
                 while len(neigh) < size:
                     new_node = random.choice(list(frontier))
                     assert new_node not in neigh
                     neigh.append(new_node)
                     visited.add(new_node)
-                    frontier += list(graph.G.neighbors(new_node))
+                    frontier += list(graph.neighbors(new_node))
                     frontier = [x for x in frontier if x not in visited]
-                if self.node_anchored:
-                    anchor = neigh[0]
-                    for v in graph.G.nodes:
-                        graph.G.nodes[v]["node_feature"] = (torch.ones(1) if
-                            anchor == v else torch.zeros(1))
-                        #print(v, graph.G.nodes[v]["node_feature"])
-                neigh = graph.G.subgraph(neigh)
+                anchor = start_node
+                neigh = graph.subgraph(neigh)
                 if use_hard_neg and train:
                     neigh = neigh.copy()
                     if random.random() < 1.0 or not self.node_anchored: # add edges
@@ -158,9 +526,6 @@ class OTFSynDataSource(DataSource):
                                 neigh.add_edge(u, v)
                     else:                         # perturb anchor
                         anchor = random.choice(list(neigh.nodes))
-                        for v in neigh.nodes:
-                            neigh.nodes[v]["node_feature"] = (torch.ones(1) if
-                                anchor == v else torch.zeros(1))
 
                 if (filter_negs and train and len(neigh) <= 6 and neg_target is
                     not None):
@@ -170,41 +535,33 @@ class OTFSynDataSource(DataSource):
                 else:
                     done = True
 
-            return graph, DSGraph(neigh)
+            return neigh, start_node, anchor
 
-        augmenter = feature_preprocess.FeatureAugment()
-
-        pos_target = batch_target
-        pos_target, pos_query = pos_target.apply_transform_multi(sample_subgraph)
-        neg_target = batch_neg_target
+        pos_target = batch_target.G
+        pos_query, pos_anchors, _ = zip(*[sample_subgraph(g)
+            for g in pos_target])
+        neg_target = batch_neg_target.G
         # TODO: use hard negs
-        hard_neg_idxs = set(random.sample(range(len(neg_target.G)),
-            int(len(neg_target.G) * 1/2)))
+        hard_neg_idxs = set(random.sample(range(len(neg_target)),
+            int(len(neg_target) * 1/2)))
         #hard_neg_idxs = set()
-        batch_neg_query = Batch.from_data_list(
-            [DSGraph(self.generator.generate(size=len(g))
-                if i not in hard_neg_idxs else g)
-                for i, g in enumerate(neg_target.G)])
-        for i, g in enumerate(batch_neg_query.G):
+        # hard negatives are sampled from the negative target itself and
+        # perturbed; the target is anchored where the sample was grown from
+        neg_query = [self.generator.generate(size=len(g))
+            if i not in hard_neg_idxs else g for i, g in enumerate(neg_target)]
+        for i, g in enumerate(neg_query):
             g.graph["idx"] = i
-        _, neg_query = batch_neg_query.apply_transform_multi(sample_subgraph,
-            hard_neg_idxs=hard_neg_idxs)
-        if self.node_anchored:
-            def add_anchor(g, anchors=None):
-                if anchors is not None:
-                    anchor = anchors[g.G.graph["idx"]]
-                else:
-                    anchor = random.choice(list(g.G.nodes))
-                for v in g.G.nodes:
-                    if "node_feature" not in g.G.nodes[v]:
-                        g.G.nodes[v]["node_feature"] = (torch.ones(1) if anchor == v
-                            else torch.zeros(1))
-                return g
-            neg_target = neg_target.apply_transform(add_anchor)
-        pos_target = augmenter.augment(pos_target).to(utils.get_device())
-        pos_query = augmenter.augment(pos_query).to(utils.get_device())
-        neg_target = augmenter.augment(neg_target).to(utils.get_device())
-        neg_query = augmenter.augment(neg_query).to(utils.get_device())
+        neg_query, neg_starts, neg_query_anchors = zip(*[sample_subgraph(g,
+            hard_neg_idxs=hard_neg_idxs) for g in neg_query])
+        neg_target_anchors = [neg_starts[i] if i in hard_neg_idxs else
+            random.choice(list(g.nodes)) for i, g in enumerate(neg_target)]
+        if not self.node_anchored:
+            pos_anchors = neg_target_anchors = neg_query_anchors = None
+        pos_target = utils.batch_nx_graphs(pos_target, anchors=pos_anchors)
+        pos_query = utils.batch_nx_graphs(pos_query, anchors=pos_anchors)
+        neg_target = utils.batch_nx_graphs(neg_target,
+            anchors=neg_target_anchors)
+        neg_query = utils.batch_nx_graphs(neg_query, anchors=neg_query_anchors)
         #print(len(pos_target.G[0]), len(pos_query.G[0]))
         return pos_target, pos_query, neg_target, neg_query
 
@@ -221,47 +578,32 @@ class OTFSynImbalancedDataSource(OTFSynDataSource):
         max_queue_size=256, node_anchored=False):
         super().__init__(max_size=max_size, min_size=min_size,
             n_workers=n_workers, node_anchored=node_anchored)
-        self.batch_idx = 0
+        self.label_store = None
+
+    # batches are generated in the calling process, which labels them with
+    # its own pool
+    gen_batches = DataSource.gen_batches
+
+    def close(self):
+        if self.label_store is not None:
+            self.label_store.close()
+            self.label_store = None
 
     def gen_batch(self, graphs_a, graphs_b, _, train):
-        def add_anchor(g):
-            anchor = random.choice(list(g.G.nodes))
-            for v in g.G.nodes:
-                g.G.nodes[v]["node_feature"] = (torch.ones(1) if anchor == v
-                    or not self.node_anchored else torch.zeros(1))
-            return g
-        pos_a, pos_b, neg_a, neg_b = [], [], [], []
-        fn = "data/cache/imbalanced-{}-{}".format(str(self.node_anchored),
-            self.batch_idx)
-        if not os.path.exists(fn):
-            graphs_a = graphs_a.apply_transform(add_anchor)
-            graphs_b = graphs_b.apply_transform(add_anchor)
-            for graph_a, graph_b in tqdm(list(zip(graphs_a.G, graphs_b.G))):
-                matcher = nx.algorithms.isomorphism.GraphMatcher(graph_a, graph_b,
-                    node_match=(lambda a, b: (a["node_feature"][0] > 0.5) ==
-                    (b["node_feature"][0] > 0.5)) if self.node_anchored else None)
-                if matcher.subgraph_is_isomorphic():
-                    pos_a.append(graph_a)
-                    pos_b.append(graph_b)
-                else:
-                    neg_a.append(graph_a)
-                    neg_b.append(graph_b)
-            if not os.path.exists("data/cache"):
-                os.makedirs("data/cache")
-            with open(fn, "wb") as f:
-                pickle.dump((pos_a, pos_b, neg_a, neg_b), f)
-            print("saved", fn)
-        else:
-            with open(fn, "rb") as f:
-                print("loaded", fn)
-                pos_a, pos_b, neg_a, neg_b = pickle.load(f)
+        if self.label_store is None:
+            self.label_store = LabelStore(LABEL_STORE_PATH,
+                n_workers=self.n_workers, timeout=LABEL_TIMEOUT)
+        if self.node_anchored:
+            for g in graphs_a.G + graphs_b.G:
+                add_anchor(g)
+        pos_a, pos_b, neg_a, neg_b = split_by_label(self.label_store,
+            graphs_a.G, graphs_b.G, self.node_anchored)
         print(len(pos_a), len(neg_a))
         if pos_a:
-            pos_a = utils.batch_nx_graphs(pos_a)
-            pos_b = utils.batch_nx_graphs(pos_b)
-        neg_a = utils.batch_nx_graphs(neg_a)
-        neg_b = utils.batch_nx_graphs(neg_b)
-        self.batch_idx += 1
+            pos_a = batch_anchored_graphs(pos_a)
+            pos_b = batch_anchored_graphs(pos_b)
+        neg_a = batch_anchored_graphs(neg_a)
+        neg_b = batch_anchored_graphs(neg_b)
         return pos_a, pos_b, neg_a, neg_b
 
 class DiskDataSource(DataSource):
@@ -273,9 +615,10 @@ class DiskDataSource(DataSource):
     See the load_dataset function for supported datasets.
     """
     def __init__(self, dataset_name, node_anchored=False, min_size=5,
-        max_size=29):
+        max_size=29, split_seed=None):
         self.node_anchored = node_anchored
-        self.dataset = load_dataset(dataset_name)
+        self.train_store, self.test_store = load_dataset_stores(dataset_name,
+            seed=split_seed)
         self.min_size = min_size
         self.max_size = max_size
 
@@ -287,66 +630,70 @@ class DiskDataSource(DataSource):
     def gen_batch(self, a, b, c, train, max_size=15, min_size=5, seed=None,
         filter_negs=False, sample_method="tree-pair"):
         batch_size = a
-        train_set, test_set, task = self.dataset
-        graphs = train_set if train else test_set
+        store = self.train_store if train else self.test_store
         if seed is not None:
             random.seed(seed)
 
+        # sampled node lists start with the sampled start node, which
+        # becomes node 0 (the anchor) of the neighborhoods built below
         pos_a, pos_b = [], []
         pos_a_anchors, pos_b_anchors = [], []
         for i in range(batch_size // 2):
             if sample_method == "tree-pair":
                 size = random.randint(min_size+1, max_size)
-                graph, a = utils.sample_neigh(graphs, size)
+                graph_idx, a = store.sample_neigh(size)
                 b = a[:random.randint(min_size, len(a) - 1)]
             elif sample_method == "subgraph-tree":
-                graph = None
-                while graph is None or len(graph) < min_size + 1:
-                    graph = random.choice(graphs)
-                a = graph.nodes
-                _, b = utils.sample_neigh([graph], random.randint(min_size,
-                    len(graph) - 1))
+                graph_idx = None
+                while (graph_idx is None or store.num_nodes(graph_idx) <
+                    min_size + 1):
+                    graph_idx = random.randrange(len(store))
+                _, b = store.sample_neigh(random.randint(min_size,
+                    store.num_nodes(graph_idx) - 1), graph_idx=graph_idx)
+                a = [b[0]] + [v for v in range(store.num_nodes(graph_idx))
+                    if v != b[0]]
             if self.node_anchored:
-                anchor = list(graph.nodes)[0]
-                pos_a_anchors.append(anchor)
-                pos_b_anchors.append(anchor)
-            neigh_a, neigh_b = graph.subgraph(a), graph.subgraph(b)
-            pos_a.append(neigh_a)
-            pos_b.append(neigh_b)
+                pos_a_anchors.append(0)
+                pos_b_anchors.append(0)
+            pos_a.append(store.neighborhood(graph_idx, a, center_loop=False))
+            pos_b.append(store.neighborhood(graph_idx, b, center_loop=False))
 
         neg_a, neg_b = [], []
         neg_a_anchors, neg_b_anchors = [], []
         while len(neg_a) < batch_size // 2:
             if sample_method == "tree-pair":
                 size = random.randint(min_size+1, max_size)
-                graph_a, a = utils.sample_neigh(graphs, size)
-                graph_b, b = utils.sample_neigh(graphs, random.randint(min_size,
+                graph_a, a = store.sample_neigh(size)
+                graph_b, b = store.sample_neigh(random.randint(min_size,
                     size - 1))
             elif sample_method == "subgraph-tree":
                 graph_a = None
-                while graph_a is None or len(graph_a) < min_size + 1:
-                    graph_a = random.choice(graphs)
-                a = graph_a.nodes
-                graph_b, b = utils.sample_neigh(graphs, random.randint(min_size,
-                    len(graph_a) - 1))
+                while (graph_a is None or store.num_nodes(graph_a) <
+                    min_size + 1):
+                    graph_a = random.randrange(len(store))
+                a = list(range(store.num_nodes(graph_a)))
+                graph_b, b = store.sample_neigh(random.randint(min_size,
+                    len(a) - 1))
             if self.node_anchored:
-                neg_a_anchors.append(list(graph_a.nodes)[0])
-                neg_b_anchors.append(list(graph_b.nodes)[0])
-            neigh_a, neigh_b = graph_a.subgraph(a), graph_b.subgraph(b)
+                neg_a_anchors.append(0)
+                neg_b_anchors.append(0)
             if filter_negs:
-                matcher = nx.algorithms.isomorphism.GraphMatcher(neigh_a, neigh_b)
+                matcher = nx.algorithms.isomorphism.GraphMatcher(
+                    store.to_networkx(graph_a, a), store.to_networkx(graph_b,
+                    b))
                 if matcher.subgraph_is_isomorphic(): # a <= b (b is subgraph of a)
                     continue
-            neg_a.append(neigh_a)
-            neg_b.append(neigh_b)
+            neg_a.append(store.neighborhood(graph_a, a, center_loop=False))
+            neg_b.append(store.neighborhood(graph_b, b, center_loop=False))
 
-        pos_a = utils.batch_nx_graphs(pos_a, anchors=pos_a_anchors if
+        # collated straight from the store's edges
+        pos_a = utils.batch_edge_indices(pos_a, anchors=pos_a_anchors if
             self.node_anchored else None)
-        pos_b = utils.batch_nx_graphs(pos_b, anchors=pos_b_anchors if
+        pos_b = utils.batch_edge_indices(pos_b, anchors=pos_b_anchors if
             self.node_anchored else None)
-        neg_a = utils.batch_nx_graphs(neg_a, anchors=neg_a_anchors if
+        neg_a = utils.batch_edge_indices(neg_a, anchors=neg_a_anchors if
             self.node_anchored else None)
-        neg_b = utils.batch_nx_graphs(neg_b, anchors=neg_b_anchors if
+        neg_b = utils.batch_edge_indices(neg_b, anchors=neg_b_anchors if
             self.node_anchored else None)
         return pos_a, pos_b, neg_a, neg_b
 
@@ -360,23 +707,33 @@ class DiskImbalancedDataSource(OTFSynDataSource):
     This setting is a challenging model inference scenario.
     """
     def __init__(self, dataset_name, max_size=29, min_size=5, n_workers=4,
-        max_queue_size=256, node_anchored=False):
+        max_queue_size=256, node_anchored=False, split_seed=None):
         super().__init__(max_size=max_size, min_size=min_size,
             n_workers=n_workers, node_anchored=node_anchored)
-        self.batch_idx = 0
-        self.dataset = load_dataset(dataset_name)
-        self.train_set, self.test_set, _ = self.dataset
+        self.label_store = None
+        self.train_store, self.test_store = load_dataset_stores(dataset_name,
+            seed=split_seed)
         self.dataset_name = dataset_name
 
+    # batches are generated in the calling process, which labels them with
+    # its own pool
+    gen_batches = DataSource.gen_batches
+
+    def close(self):
+        if self.label_store is not None:
+            self.label_store.close()
+            self.label_store = None
+
     def gen_data_loaders(self, size, batch_size, train=True,
         use_distributed_sampling=False):
         loaders = []
         for i in range(2):
+            store = self.train_store if train else self.test_store
             neighs = []
             for j in range(size // 2):
-                graph, neigh = utils.sample_neigh(self.train_set if train else
-                    self.test_set, random.randint(self.min_size, self.max_size))
-                neighs.append(graph.subgraph(neigh))
+                graph_idx, neigh = store.sample_neigh(random.randint(
+                    self.min_size, self.max_size))
+                neighs.append(store.to_networkx(graph_idx, neigh))
             dataset = GraphDataset(neighs)
             loaders.append(TorchDataLoader(dataset,
                 collate_fn=Batch.collate([]), batch_size=batch_size // 2 if i
@@ -386,52 +743,27 @@ class DiskImbalancedDataSource(OTFSynDataSource):
         return loaders
 
     def gen_batch(self, graphs_a, graphs_b, _, train):
-        def add_anchor(g):
-            anchor = random.choice(list(g.G.nodes))
-            for v in g.G.nodes:
-                g.G.nodes[v]["node_feature"] = (torch.ones(1) if anchor == v
-                    or not self.node_anchored else torch.zeros(1))
-            return g
-        pos_a, pos_b, neg_a, neg_b = [], [], [], []
-        fn = "data/cache/imbalanced-{}-{}-{}".format(self.dataset_name.lower(),
-            str(self.node_anchored), self.batch_idx)
-        if not os.path.exists(fn):
-            graphs_a = graphs_a.apply_transform(add_anchor)
-            graphs_b = graphs_b.apply_transform(add_anchor)
-            for graph_a, graph_b in tqdm(list(zip(graphs_a.G, graphs_b.G))):
-                matcher = nx.algorithms.isomorphism.GraphMatcher(graph_a, graph_b,
-                    node_match=(lambda a, b: (a["node_feature"][0] > 0.5) ==
-                    (b["node_feature"][0] > 0.5)) if self.node_anchored else None)
-                if matcher.subgraph_is_isomorphic():
-                    pos_a.append(graph_a)
-                    pos_b.append(graph_b)
-                else:
-                    neg_a.append(graph_a)
-                    neg_b.append(graph_b)
-            if not os.path.exists("data/cache"):
-                os.makedirs("data/cache")
-            with open(fn, "wb") as f:
-                pickle.dump((pos_a, pos_b, neg_a, neg_b), f)
-            print("saved", fn)
-        else:
-            with open(fn, "rb") as f:
-                print("loaded", fn)
-                pos_a, pos_b, neg_a, neg_b = pickle.load(f)
+        if self.label_store is None:
+            self.label_store = LabelStore(LABEL_STORE_PATH,
+                n_workers=self.n_workers, timeout=LABEL_TIMEOUT)
+        if self.node_anchored:
+            for g in graphs_a.G + graphs_b.G:
+                add_anchor(g)
+        pos_a, pos_b, neg_a, neg_b = split_by_label(self.label_store,
+            graphs_a.G, graphs_b.G, self.node_anchored)
         print(len(pos_a), len(neg_a))
         if pos_a:
-            pos_a = utils.batch_nx_graphs(pos_a)
-            pos_b = utils.batch_nx_graphs(pos_b)
-        neg_a = utils.batch_nx_graphs(neg_a)
-        neg_b = utils.batch_nx_graphs(neg_b)
-        self.batch_idx += 1
+            pos_a = batch_anchored_graphs(pos_a)
+            pos_b = batch_anchored_graphs(pos_b)
+        neg_a = batch_anchored_graphs(neg_a)
+        neg_b = batch_anchored_graphs(neg_b)
         return pos_a, pos_b, neg_a, neg_b
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
     plt.rcParams.update({"font.size": 14})
     for name in ["enzymes", "reddit-binary", "cox2"]:
-        data_source = DiskDataSource(name)
-        train, test, _ = data_source.dataset
+        train, test, _ = load_dataset(name)
         i = 11
         neighs = [utils.sample_neigh(train, i) for j in range(10000)]
         clustering = [nx.average_clustering(graph.subgraph(nodes)) for graph,
@@ -0,0 +1,466 @@
+"""Compact CSR storage for collections of undirected graphs.
+
+All graphs of a dataset share one pair of CSR arrays. Nodes of graph i are
+numbered node_offsets[i] .. node_offsets[i+1] - 1 in the global arrays, and
+methods take and return node ids local to a graph (0 .. n_i - 1, in the
+iteration order of the networkx graph the store was built from).
+"""
+import array
+import os
+import random
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+import torch.multiprocessing as mp
+
+class GraphStore:
+    def __init__(self, indptr, indices, node_offsets):
+        """
+        Args:
+            indptr: CSR row pointers over all nodes of all graphs
+                (length total_nodes + 1).
+            indices: global ids of the neighbors of each node. Undirected
+                edges appear once in each direction, self loops once.
+            node_offsets: first global node id of each graph, followed by
+                total_nodes (length n_graphs + 1).
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.node_offsets = node_offsets
+        self.path = None
+        self._sampler = None
+        # (graph_idx, adjacency matrix) of the last graph passed to adjacency
+        self._adj = None
+
+    @classmethod
+    def from_networkx(cls, graphs):
+        node_offsets = np.zeros(len(graphs) + 1, dtype=np.int64)
+        srcs, dsts = [], []
+        for i, graph in enumerate(graphs):
+            offset = node_offsets[i]
+            mapping = {v: j for j, v in enumerate(graph.nodes)}
+            edges = np.array([(mapping[u], mapping[v]) for u, v in
+                graph.edges], dtype=np.int64).reshape(-1, 2) + offset
+            loops = edges[:,0] == edges[:,1]
+            srcs += [edges[:,0], edges[~loops,1]]
+            dsts += [edges[:,1], edges[~loops,0]]
+            node_offsets[i+1] = offset + len(graph)
+        return cls.from_edges(np.concatenate(srcs), np.concatenate(dsts),
+            node_offsets)
+
+    @classmethod
+    def from_edge_list(cls, path, delimiter=None):
+        """Builds a single-graph store from a text edge list with one "u v"
+        pair per line. Lines starting with # or % are skipped, as are
+        columns after the second. Nodes are numbered in order of first
+        appearance and duplicate edges are dropped."""
+        ids = array.array("q")
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip() or line[0] in "#%": continue
+                u, v = line.split(delimiter)[:2]
+                ids.append(int(u))
+                ids.append(int(v))
+        ids = np.frombuffer(ids, dtype=np.int64)
+        uniq, first, inv = np.unique(ids, return_index=True,
+            return_inverse=True)
+        rank = np.empty(len(uniq), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(uniq))
+        edges = rank[inv].reshape(-1, 2)
+        edges = np.unique(np.sort(edges, axis=1).view([("u", np.int64),
+            ("v", np.int64)])).view(np.int64).reshape(-1, 2)
+        loops = edges[:,0] == edges[:,1]
+        src = np.concatenate((edges[:,0], edges[~loops,1]))
+        dst = np.concatenate((edges[:,1], edges[~loops,0]))
+        return cls.from_edges(src, dst, np.array([0, len(uniq)]))
+
+    @classmethod
+    def from_edges(cls, src, dst, node_offsets):
+        """Build a store from directed global edge arrays (both directions
+        of every undirected edge must be present)."""
+        n_nodes = node_offsets[-1]
+        order = np.lexsort((dst, src))
+        indices = dst[order].astype(np.int64)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+        return cls(indptr, indices, np.asarray(node_offsets, dtype=np.int64))
+
+    def save(self, path):
+        """Saves the arrays as .npy files in directory path."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for key in ["indptr", "indices", "node_offsets"]:
+            np.save(os.path.join(path, key + ".npy"), getattr(self, key))
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Loads a store written by save. With mmap_mode="r" the arrays are
+        memory-mapped rather than read into memory."""
+        store = cls(*[np.load(os.path.join(path, key + ".npy"),
+            mmap_mode=mmap_mode) for key in ["indptr", "indices",
+            "node_offsets"]])
+        store.path = path
+        return store
+
+    def __len__(self):
+        return len(self.node_offsets) - 1
+
+    def subset(self, graph_idxs):
+        """Store of the graphs graph_idxs of this store, in that order, sliced
+        from the CSR arrays."""
+        indptr, indices = [np.zeros(0, dtype=np.int64)], [np.zeros(0,
+            dtype=np.int64)]
+        node_offsets = [0]
+        n_edges = 0
+        for graph_idx in graph_idxs:
+            lo, hi = (self.node_offsets[graph_idx],
+                self.node_offsets[graph_idx+1])
+            start, end = self.indptr[lo], self.indptr[hi]
+            indptr.append(self.indptr[lo:hi] - start + n_edges)
+            indices.append(self.indices[start:end] - lo + node_offsets[-1])
+            node_offsets.append(node_offsets[-1] + hi - lo)
+            n_edges += end - start
+        indptr.append(np.array([n_edges], dtype=np.int64))
+        return GraphStore(np.concatenate(indptr), np.concatenate(indices),
+            np.array(node_offsets, dtype=np.int64))
+
+    @property
+    def graph_sizes(self):
+        return np.diff(self.node_offsets)
+
+    def num_nodes(self, graph_idx):
+        return int(self.node_offsets[graph_idx+1] -
+            self.node_offsets[graph_idx])
+
+    def neighbors(self, graph_idx, node):
+        """Local ids of the neighbors of node in graph graph_idx."""
+        offset = self.node_offsets[graph_idx]
+        v = offset + node
+        return self.indices[self.indptr[v]:self.indptr[v+1]] - offset
+
+    @property
+    def sampler(self):
+        """NeighborhoodSampler over this store, built on first use."""
+        if self._sampler is None:
+            self._sampler = NeighborhoodSampler(self)
+        return self._sampler
+
+    def sample_neigh(self, size, graph_idx=None):
+        """Tree-structured neighborhood sampling, as in utils.sample_neigh.
+        The graph is chosen with probability proportional to its size unless
+        graph_idx is given.
+
+        Returns: (graph_idx, list of local node ids), with the start node
+            first.
+        """
+        return self.sampler.sample_neigh(size, graph_idx=graph_idx)
+
+    def grow_neigh(self, graph_idx, start_node, size):
+        """Grows a neighborhood from start_node by repeatedly adding a random
+        frontier node, until it has size nodes or the component is exhausted.
+        Frontier nodes are weighted by their number of edges into the
+        neighborhood."""
+        neigh = [start_node]
+        visited = set(neigh)
+        frontier = [x for x in set(self.neighbors(graph_idx,
+            start_node).tolist()) if x not in visited]
+        while len(neigh) < size and frontier:
+            new_node = random.choice(frontier)
+            neigh.append(new_node)
+            visited.add(new_node)
+            frontier += self.neighbors(graph_idx, new_node).tolist()
+            frontier = [x for x in frontier if x not in visited]
+        return neigh
+
+    def ball(self, graph_idx, node, radius):
+        """Local ids of the nodes within radius hops of node, node first and
+        the rest in breadth-first order."""
+        offset = self.node_offsets[graph_idx]
+        seen = {offset + node}
+        ball, frontier = [offset + node], np.array([offset + node])
+        for _ in range(radius):
+            starts, ends = self.indptr[frontier], self.indptr[frontier+1]
+            nbrs = np.unique(np.concatenate([self.indices[a:b] for a, b in
+                zip(starts, ends)]))
+            frontier = np.array([v for v in nbrs.tolist() if v not in seen],
+                dtype=np.int64)
+            if len(frontier) == 0: break
+            seen.update(frontier.tolist())
+            ball += frontier.tolist()
+        return [v - int(offset) for v in ball]
+
+    def subgraph_edges(self, graph_idx, nodes):
+        """Edges of the subgraph induced by nodes, as a (2, E) numpy array
+        of positions in nodes. Both directions of every edge are listed."""
+        nodes = np.asarray(nodes, dtype=np.int64) + self.node_offsets[
+            graph_idx]
+        starts, ends = self.indptr[nodes], self.indptr[nodes+1]
+        counts = ends - starts
+        src = np.repeat(np.arange(len(nodes)), counts)
+        # gather all neighbor lists in one pass
+        nbr_pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+            counts, counts) + np.repeat(starts, counts)
+        nbrs = self.indices[nbr_pos]
+        order = np.argsort(nodes)
+        pos = np.searchsorted(nodes[order], nbrs)
+        pos[pos == len(nodes)] = 0
+        mask = nodes[order][pos] == nbrs
+        return np.stack((src[mask], order[pos[mask]]))
+
+    def adjacency(self, graph_idx):
+        """scipy CSR adjacency matrix of graph graph_idx, in local ids. The
+        matrix of the last graph asked for is kept, so that callers going
+        through a graph in chunks (see radial_neighborhoods) build it once."""
+        if self._adj is None or self._adj[0] != graph_idx:
+            offset = self.node_offsets[graph_idx]
+            n = self.num_nodes(graph_idx)
+            lo, hi = self.indptr[offset], self.indptr[offset + n]
+            self._adj = (graph_idx, sp.csr_matrix((np.ones(hi - lo,
+                dtype=np.int32), self.indices[lo:hi] - offset,
+                self.indptr[offset:offset+n+1] - lo), shape=(n, n)))
+        return self._adj[1]
+
+    def balls(self, graph_idx, centers, radius):
+        """Nodes within radius hops of each of centers in graph graph_idx, by
+        sparse frontier expansion over all centers at once.
+
+        Returns: (owner, members) arrays of local ids, grouped by center in
+            the order of centers. Each group starts with its center, followed
+            by the other members in increasing order.
+        """
+        n = self.num_nodes(graph_idx)
+        adj = self.adjacency(graph_idx)
+        centers = np.asarray(centers, dtype=np.int64)
+        reach = sp.csr_matrix((np.ones(len(centers), dtype=np.int32), (np.arange(
+            len(centers)), centers)), shape=(len(centers), n))
+        frontier = reach
+        for _ in range(radius):
+            frontier = frontier.dot(adj)
+            frontier.data[:] = 1
+            frontier = frontier - frontier.multiply(reach)
+            frontier.eliminate_zeros()
+            if frontier.nnz == 0: break
+            reach = reach + frontier
+        reach = reach.tocoo()
+        # sort by owner, center first, then by node
+        order = np.lexsort((reach.col, reach.col != centers[reach.row],
+            reach.row))
+        return reach.row[order].astype(np.int64), reach.col[order].astype(
+            np.int64)
+
+    def batch_subgraph_edges(self, graph_idx, owner, members):
+        """subgraph_edges for many node sets at once: members grouped by
+        owner (as returned by balls). Returns (2, E) positions in members."""
+        offset = self.node_offsets[graph_idx]
+        nodes = members + offset
+        starts, ends = self.indptr[nodes], self.indptr[nodes+1]
+        counts = ends - starts
+        src = np.repeat(np.arange(len(nodes)), counts)
+        nbr_pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+            counts, counts) + np.repeat(starts, counts)
+        # look up (owner, neighbor) among the (owner, member) keys
+        n = self.num_nodes(graph_idx)
+        keys = owner * n + members
+        order = np.argsort(keys)
+        nbr_keys = owner[src] * n + self.indices[nbr_pos] - offset
+        pos = np.searchsorted(keys[order], nbr_keys)
+        pos[pos == len(keys)] = 0
+        mask = keys[order][pos] == nbr_keys
+        return np.stack((src[mask], order[pos[mask]]))
+
+    def neighborhood(self, graph_idx, nodes, center_loop=True):
+        """The subgraph induced by nodes as an (n_nodes, edge_index) pair in
+        the format of radial_chunk: self loops are listed twice, and with
+        center_loop node 0 gets one if it has none."""
+        src, dst = self.subgraph_edges(graph_idx, nodes)
+        loops = src[src == dst]
+        extra = ([0, 0] if center_loop and len(nodes) and not (loops ==
+            0).any() else [])
+        src = np.concatenate((src, loops, np.array(extra, dtype=np.int64)))
+        dst = np.concatenate((dst, loops, np.array(extra, dtype=np.int64)))
+        return len(nodes), np.stack((src, dst))
+
+    def to_networkx(self, graph_idx, nodes=None):
+        """The subgraph induced by nodes (by default the whole graph) as a
+        new networkx graph whose node i is nodes[i]."""
+        if nodes is None:
+            nodes = np.arange(self.num_nodes(graph_idx))
+        src, dst = self.subgraph_edges(graph_idx, nodes)
+        graph = nx.Graph()
+        graph.add_nodes_from(range(len(nodes)))
+        graph.add_edges_from(zip(src.tolist(), dst.tolist()))
+        return graph
+
+RADIAL_CHUNK_SIZE = 1024
+
+def radial_chunk(store, graph_idx, centers, radius, sample_size=0, rng=None):
+    """Neighborhoods of radius hops around each of centers, as
+    (n_nodes, edge_index) pairs ready for utils.batch_edge_indices. Node 0 is
+    the center and has a self loop; self loops appear twice in edge_index
+    and other edges once in each direction, as in utils.batch_nx_graphs.
+    Neighborhoods of a single node are skipped.
+
+    With sample_size, each neighborhood is cut down to the center and
+    sample_size - 1 random other members (drawn with rng, a
+    numpy RandomState), then to the center's connected component.
+    """
+    owner, members = store.balls(graph_idx, centers, radius)
+    group_start = np.searchsorted(owner, np.arange(len(centers)))
+    if sample_size:
+        keep = np.ones(len(members), dtype=bool)
+        group_end = np.append(group_start[1:], len(members))
+        for a, b in zip(group_start.tolist(), group_end.tolist()):
+            if b - a > sample_size:
+                keep[a+1:b] = False
+                keep[a + 1 + rng.choice(b - a - 1, sample_size - 1,
+                    replace=False)] = True
+        owner, members = owner[keep], members[keep]
+        group_start = np.searchsorted(owner, np.arange(len(centers)))
+        src, dst = store.batch_subgraph_edges(graph_idx, owner, members)
+        _, comp = connected_components(sp.csr_matrix((np.ones(len(src),
+            dtype=np.int8), (src, dst)), shape=(len(members), len(members))),
+            directed=False)
+        keep = comp == comp[group_start[owner]]
+        owner, members = owner[keep], members[keep]
+        group_start = np.searchsorted(owner, np.arange(len(centers)))
+    src, dst = store.batch_subgraph_edges(graph_idx, owner, members)
+    loops = src[src == dst]
+    has_loop = np.zeros(len(centers), dtype=bool)
+    has_loop[owner[loops[loops == group_start[owner[loops]]]]] = True
+    new_loops = group_start[~has_loop]
+    src = np.concatenate((src, loops, new_loops, new_loops))
+    dst = np.concatenate((dst, loops, new_loops, new_loops))
+    # split the edges by neighborhood
+    order = np.argsort(owner[src], kind="mergesort")
+    src, dst = src[order], dst[order]
+    edge_start = np.searchsorted(owner[src], np.arange(len(centers) + 1))
+    group_end = np.append(group_start[1:], len(members))
+    neighs = []
+    for i in range(len(centers)):
+        a, b = group_start[i], group_end[i]
+        if b - a < 2: continue
+        e_a, e_b = edge_start[i], edge_start[i+1]
+        neighs.append((int(b - a), np.stack((src[e_a:e_b] - a,
+            dst[e_a:e_b] - a))))
+    return neighs
+
+# store of the radial extraction workers, see radial_neighborhoods
+radial_store = None
+
+def init_radial_worker(store):
+    global radial_store
+    radial_store = (GraphStore.load(store, mmap_mode="r") if
+        isinstance(store, str) else store)
+
+def radial_worker(inp):
+    graph_idx, start, end, radius, sample_size, seed = inp
+    rng = np.random.RandomState([seed, graph_idx, start])
+    return radial_chunk(radial_store, graph_idx, np.arange(start, end),
+        radius, sample_size=sample_size, rng=rng)
+
+def radial_neighborhoods(store, radius, sample_size=0, n_workers=0,
+    chunk_size=RADIAL_CHUNK_SIZE, seed=0):
+    """Generates the radial neighborhoods (see radial_chunk) around every
+    node of every graph of store, in order. Centers are processed in chunks
+    of chunk_size nodes, spread over n_workers processes if n_workers > 0.
+    Workers memory-map the store if it was loaded from disk. The sampling
+    only depends on seed, not on n_workers."""
+    jobs = [(graph_idx, start, min(start + chunk_size, n), radius,
+        sample_size, seed) for graph_idx, n in enumerate(
+        store.graph_sizes.tolist()) for start in range(0, n, chunk_size)]
+    if n_workers > 0:
+        pool = mp.Pool(n_workers, initializer=init_radial_worker,
+            initargs=(store.path if store.path is not None else store,))
+        try:
+            for neighs in pool.imap(radial_worker, jobs):
+                yield from neighs
+        finally:
+            pool.terminate()
+    else:
+        init_radial_worker(store)
+        for job in jobs:
+            yield from radial_worker(job)
+
+class AliasTable:
+    """Walker's alias method: O(1) sampling from a fixed discrete
+    distribution after O(n) setup."""
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        prob = weights * n / np.sum(weights)
+        alias = np.arange(n)
+        small = [i for i in range(n) if prob[i] < 1.0]
+        large = [i for i in range(n) if prob[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            (small if prob[l] < 1.0 else large).append(l)
+        # leftovers are 1 up to rounding error
+        for i in small + large:
+            prob[i] = 1.0
+        self.prob = prob.tolist()
+        self.alias = alias.tolist()
+
+    def sample(self):
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+class NeighborhoodSampler:
+    """Samples tree neighborhoods of a GraphStore without retries.
+
+    Start nodes are drawn uniformly among the nodes whose connected component
+    has at least size nodes, which is the distribution the retry loop in
+    utils.sample_neigh converges to: the graph is picked from a per-size
+    alias table weighted by its number of such nodes, then the start node
+    uniformly among them.
+    """
+    def __init__(self, store):
+        self.store = store
+        n_nodes = int(store.node_offsets[-1])
+        adj = sp.csr_matrix((np.ones(len(store.indices), dtype=np.int8),
+            store.indices, store.indptr), shape=(n_nodes, n_nodes))
+        _, labels = connected_components(adj, directed=False)
+        self.comp_sizes = np.bincount(labels)[labels]
+        self.graph_of_node = np.repeat(np.arange(len(store)),
+            store.graph_sizes)
+        # nodes of each graph, ordered by decreasing component size, so the
+        # nodes able to reach size nodes form a prefix of each graph's range
+        order = np.lexsort((-self.comp_sizes, self.graph_of_node))
+        self.sorted_nodes = order - store.node_offsets[
+            self.graph_of_node[order]]
+        self.tables = {}
+
+    def n_eligible(self, size):
+        """Number of nodes of each graph whose component has >= size nodes."""
+        return np.bincount(self.graph_of_node[self.comp_sizes >= size],
+            minlength=len(self.store))
+
+    def _table(self, size):
+        if size not in self.tables:
+            counts = self.n_eligible(size)
+            if counts.sum() == 0:
+                raise ValueError("no connected component has {} "
+                    "nodes".format(size))
+            self.tables[size] = AliasTable(counts), counts
+        return self.tables[size]
+
+    def sample_start(self, size, graph_idx=None):
+        """Random (graph_idx, node) from which size nodes are reachable."""
+        if graph_idx is None:
+            table, counts = self._table(size)
+            graph_idx = table.sample()
+        else:
+            counts = self._table(size)[1]
+            if counts[graph_idx] == 0:
+                raise ValueError("graph {} has no connected component with "
+                    "{} nodes".format(graph_idx, size))
+        k = random.randrange(counts[graph_idx])
+        return graph_idx, int(self.sorted_nodes[self.store.node_offsets[
+            graph_idx] + k])
+
+    def sample_neigh(self, size, graph_idx=None):
+        graph_idx, start_node = self.sample_start(size, graph_idx=graph_idx)
+        return graph_idx, self.store.grow_neigh(graph_idx, start_node, size)
@@ -0,0 +1,136 @@
+"""Ground-truth subgraph labels for graph pairs, computed in a process pool and
+cached on disk.
+
+Labels are keyed by a hash of the canonical forms of both graphs (see
+common/canonical.py), so a pair is only matched once across runs and data
+sources, whatever the node order of the sampled graphs.
+"""
+import hashlib
+import os
+import signal
+import sqlite3
+
+import networkx.algorithms.isomorphism as iso
+import torch.multiprocessing as mp
+
+from common import canonical
+
+# seconds a connection waits for another process's write to finish
+SQLITE_BUSY_TIMEOUT = 60
+
+class LabelTimeout(Exception):
+    pass
+
+def _raise_timeout(signum, frame):
+    raise LabelTimeout()
+
+def pair_key(graph_a, graph_b, anchored):
+    """Hash of the canonical keys of both graphs (anchored at the nodes whose
+    "anchor" attribute is 1 if anchored): equal for pairs of isomorphic
+    graphs."""
+    return hashlib.sha1("{}|{}|{}".format(int(anchored),
+        canonical.canonical_key(graph_a, node_anchored=anchored),
+        canonical.canonical_key(graph_b, node_anchored=anchored)).encode()
+        ).hexdigest()
+
+def label_pair(inp):
+    """Pool worker: whether graph_b is a subgraph of graph_a (matching the
+    "anchor" attribute if anchored), or None if it takes longer than timeout
+    seconds."""
+    idx, graph_a, graph_b, anchored, timeout = inp
+    matcher = iso.GraphMatcher(graph_a, graph_b,
+        node_match=iso.categorical_node_match("anchor", 0) if anchored else
+        None)
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        label = matcher.subgraph_is_isomorphic()
+    except LabelTimeout:
+        label = None
+    finally:
+        signal.alarm(0)
+    return idx, label
+
+class LabelStore:
+    """sqlite3 table from pair_key to label."""
+    def __init__(self, path, n_workers=4, timeout=10):
+        """
+        Args:
+            path: sqlite3 database file, created if missing.
+            n_workers: processes used to label pairs missing from the store.
+            timeout: seconds allowed per pair; pairs that time out get no
+                label and are not stored.
+        """
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.pool = None
+        self.connect()
+
+    def connect(self):
+        # several training processes may share the file: wait for each
+        # other's writes, and let readers proceed during a write
+        self.conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS labels "
+            "(key TEXT PRIMARY KEY, label INTEGER)")
+
+    def __getstate__(self):
+        # the connection and the pool cannot be pickled (e.g. to spawn a
+        # training worker); the copy opens its own
+        state = self.__dict__.copy()
+        del state["conn"]
+        state["pool"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.connect()
+
+    def lookup(self, keys):
+        labels = {}
+        keys = list(set(keys))
+        # sqlite limits the number of parameters per query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            labels.update(self.conn.execute("SELECT key, label FROM labels "
+                "WHERE key IN ({})".format(",".join("?" * len(chunk))),
+                chunk).fetchall())
+        return {k: bool(v) for k, v in labels.items()}
+
+    def label(self, graphs_a, graphs_b, anchored):
+        """Labels of the pairs (graphs_a[i], graphs_b[i]): True if graphs_b[i]
+        is a subgraph of graphs_a[i], False if not, None on timeout."""
+        keys = [pair_key(a, b, anchored) for a, b in zip(graphs_a, graphs_b)]
+        known = self.lookup(keys)
+        todo = {}
+        for i, key in enumerate(keys):
+            if key not in known and key not in todo:
+                todo[key] = i
+        if todo:
+            if self.n_workers > 0:
+                if self.pool is None:
+                    self.pool = mp.Pool(self.n_workers)
+                results = self.pool.imap_unordered(label_pair, [(i,
+                    graphs_a[i], graphs_b[i], anchored, self.timeout) for i in
+                    todo.values()])
+            else:
+                results = map(label_pair, [(i, graphs_a[i], graphs_b[i],
+                    anchored, self.timeout) for i in todo.values()])
+            new = {keys[i]: label for i, label in results}
+            self.conn.executemany("INSERT OR REPLACE INTO labels VALUES (?, ?)",
+                [(k, int(v)) for k, v in new.items() if v is not None])
+            self.conn.commit()
+            n_timeouts = sum(v is None for v in new.values())
+            if n_timeouts:
+                print("{} pairs timed out".format(n_timeouts))
+            known.update(new)
+        return [known[key] for key in keys]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.conn.close()
@@ -1,6 +1,10 @@
 """Defines all graph embedding models"""
+from collections import OrderedDict
 from functools import reduce
+import hashlib
+from multiprocessing.managers import BaseManager
 import random
+import threading
 
 import networkx as nx
 import numpy as np
@@ -10,9 +14,15 @@ import torch.nn.functional as F
 import torch_geometric.nn as pyg_nn
 import torch_geometric.utils as pyg_utils
 
+from common import canonical
 from common import utils
 from common import feature_preprocess
 
+EMB_CACHE_SIZE = 2**16
+# larger graphs are cached under their labelled structure instead of their
+# canonical form, see EmbeddingCache.graph_keys
+CANONICAL_KEY_MAX_NODES = 32
+
 # GNN -> concat -> MLP graph classification baseline
 class BaselineMLP(nn.Module):
     def __init__(self, input_dim, hidden_dim, args):
@@ -22,8 +32,8 @@ class BaselineMLP(nn.Module):
             nn.Linear(256, 2))
 
     def forward(self, emb_motif, emb_motif_mod):
-        pred = self.mlp(torch.cat((emb_motif, emb_motif_mod), dim=1))
-        pred = F.log_softmax(pred, dim=1)
+        pred = self.mlp(torch.cat((emb_motif, emb_motif_mod), dim=-1))
+        pred = F.log_softmax(pred, dim=-1)
         return pred
 
     def predict(self, pred):
@@ -48,14 +58,15 @@ class OrderEmbedder(nn.Module):
     def predict(self, pred):
         """Predict if b is a subgraph of a (batched), where emb_as, emb_bs = pred.
 
-        pred: list (emb_as, emb_bs) of embeddings of graph pairs
+        pred: list (emb_as, emb_bs) of embeddings of graph pairs. Leading
+            dimensions broadcast, so a (1, n, d) and a (m, 1, d) input give
+            an (m, n) grid of scores.
 
         Returns: list of bools (whether a is subgraph of b in the pair)
         """
         emb_as, emb_bs = pred
 
-        e = torch.sum(torch.max(torch.zeros_like(emb_as,
-            device=emb_as.device), emb_bs - emb_as)**2, dim=1)
+        e = torch.sum(torch.clamp(emb_bs - emb_as, min=0)**2, dim=-1)
         return e
 
     def criterion(self, pred, intersect_embs, labels):
@@ -156,6 +167,15 @@ class SkipLastGNN(nn.Module):
             print("unrecognized model type")
 
     def forward(self, data):
+        emb = pyg_nn.global_add_pool(self.node_states(data), data.batch)
+        emb = self.post_mp(emb)
+        #emb = self.batch_norm(emb)   # TODO: test
+        #out = F.log_softmax(emb, dim=1)
+        return emb
+
+    def node_states(self, data):
+        """Per-node outputs of pre_mp and of every conv layer, concatenated
+        (the node embeddings that forward pools)."""
         #if data.x is None:
         #    data.x = torch.ones((data.num_nodes, 1), device=utils.get_device())
 
@@ -164,7 +184,11 @@ class SkipLastGNN(nn.Module):
             if not hasattr(data, "preprocessed"):
                 data = self.feat_preprocess(data)
                 data.preprocessed = True
-        x, edge_index, batch = data.node_feature, data.edge_index, data.batch
+        x, edge_index, batch = (getattr(data, "node_feature", None),
+            data.edge_index, data.batch)
+        if x is None:
+            # anchored batches carry anchor indices instead of features
+            x = utils.anchor_node_features(data)
         x = self.pre_mp(x)
 
         all_emb = x.unsqueeze(1)
@@ -196,14 +220,116 @@ class SkipLastGNN(nn.Module):
             emb = torch.cat((emb, x), 1)
             if self.skip == 'learnable':
                 all_emb = torch.cat((all_emb, x.unsqueeze(1)), 1)
-
-        # x = pyg_nn.global_mean_pool(x, batch)
-        emb = pyg_nn.global_add_pool(emb, batch)
-        emb = self.post_mp(emb)
-        #emb = self.batch_norm(emb)   # TODO: test
-        #out = F.log_softmax(emb, dim=1)
         return emb
 
+    def supports_extensions(self):
+        """Whether embed_extensions applies: in eval mode, for convs that
+        only aggregate over neighbors, without feature augmentation."""
+        return (not self.training and self.conv_type in ["SAGE", "GIN"] and
+            self.feat_preprocess is None)
+
+    def layer_input(self, i, states):
+        """Input of conv layer i given the states of layers < i (columns of
+        node_states)."""
+        if self.skip == 'learnable':
+            hidden_dim = self.pre_mp[0].out_features
+            skip_vals = self.learnable_skip[i, :i+1].view(1, i+1, 1)
+            return (states.view(states.size(0), i+1, hidden_dim) *
+                torch.sigmoid(skip_vals)).view(states.size(0), -1)
+        elif self.skip == 'all':
+            return states
+        else:
+            return states[:, -self.pre_mp[0].out_features:]
+
+    def embed_extensions(self, states, batch, edge_index, parents,
+        attachments, anchored):
+        """Embeddings of one-node extensions of a batch of patterns, reusing
+        the patterns' node states. Only nodes within i hops of the new node
+        are recomputed at layer i, and the pooled sum is updated by their
+        change, so the result matches forward on the extended graphs up to
+        rounding. Requires supports_extensions().
+
+        Args:
+            states: node_states of the batch of patterns.
+            batch, edge_index: batch vector and edge_index of that batch.
+            parents: pattern index of each extension.
+            attachments: for each extension, the batch indices of the nodes
+                of its pattern that the new node is connected to.
+            anchored: whether the batch is anchored (the new node is then
+                not the anchor).
+        """
+        device = states.device
+        hidden_dim = self.pre_mp[0].out_features
+        parents = torch.as_tensor(parents, dtype=torch.long, device=device)
+        n_nodes = torch.bincount(batch, minlength=int(parents.max()) + 1 if
+            len(parents) else 0)
+        starts = torch.cumsum(n_nodes, 0) - n_nodes
+        # one copy of its pattern plus the new node (last) per extension
+        sizes = n_nodes[parents] + 1
+        offsets = torch.cumsum(sizes, 0) - sizes
+        row_ext = torch.repeat_interleave(torch.arange(len(parents),
+            device=device), sizes)
+        local = torch.arange(len(row_ext), device=device) - offsets[row_ext]
+        is_new = local == sizes[row_ext] - 1
+        orig = (starts[parents][row_ext] + local).clamp(max=len(states) - 1)
+
+        # pattern edges, repeated for each extension of the pattern
+        edge_graph = batch[edge_index[0]]
+        order = torch.argsort(edge_graph)
+        edge_index = edge_index[:, order]
+        e_counts = torch.bincount(edge_graph, minlength=len(n_nodes))
+        e_starts = torch.cumsum(e_counts, 0) - e_counts
+        e_sizes = e_counts[parents]
+        e_ext = torch.repeat_interleave(torch.arange(len(parents),
+            device=device), e_sizes)
+        e_pos = (torch.arange(len(e_ext), device=device) - (torch.cumsum(
+            e_sizes, 0) - e_sizes)[e_ext] + e_starts[parents][e_ext])
+        shift = offsets - starts[parents]
+        src = edge_index[0, e_pos] + shift[e_ext]
+        dst = edge_index[1, e_pos] + shift[e_ext]
+        # edges of the new nodes
+        a_ext = torch.tensor([j for j, a in enumerate(attachments) for _ in a],
+            dtype=torch.long, device=device)
+        a_node = torch.tensor([v for a in attachments for v in a],
+            dtype=torch.long, device=device) + shift[a_ext]
+        new_node = offsets + sizes - 1
+        src = torch.cat((src, a_node, new_node[a_ext]))
+        dst = torch.cat((dst, new_node[a_ext], a_node))
+
+        # hops from the new node
+        n_layers = self.n_layers
+        dist = torch.full((len(row_ext),), n_layers + 1, dtype=torch.long,
+            device=device)
+        dist[new_node] = 0
+        for r in range(1, n_layers + 1):
+            reached = torch.zeros_like(is_new)
+            reached[dst[dist[src] == r - 1]] = True
+            dist[reached & (dist > r)] = r
+
+        old = states[orig] * (~is_new).float().unsqueeze(1)
+        emb = old.clone()
+        x = torch.full((len(new_node), 1), 0.0 if anchored else 1.0,
+            device=device)
+        emb[new_node, :hidden_dim] = self.pre_mp(x)
+        for i in range(n_layers):
+            active = (dist <= i + 1).nonzero().view(-1)
+            mask = dist[dst] <= i + 1
+            needed = torch.unique(torch.cat((active, src[mask])))
+            pos = torch.full((len(row_ext),), -1, dtype=torch.long,
+                device=device)
+            pos[needed] = torch.arange(len(needed), device=device)
+            sub_edges = torch.stack((pos[src[mask]], pos[dst[mask]]))
+            x = self.convs[i](self.layer_input(i, emb[needed,
+                :(i+1)*hidden_dim]), sub_edges)
+            x = F.relu(x)
+            emb[active, (i+1)*hidden_dim:(i+2)*hidden_dim] = x[pos[active]]
+
+        changed = dist <= n_layers
+        pooled = pyg_nn.global_add_pool(states, batch)[parents]
+        pooled = pooled.index_add(0, row_ext[changed], emb[changed] -
+            old[changed])
+        return self.post_mp(pooled)
+
     def loss(self, pred, label):
         return F.nll_loss(pred, label)
 
@@ -288,3 +414,135 @@ class GINConv(pyg_nn.MessagePassing):
     def __repr__(self):
         return '{}(nn={})'.format(self.__class__.__name__, self.nn)
 
+
+def model_fingerprint(model):
+    """Hash of the parameters and buffers of model, identifying the
+    checkpoint that its embeddings come from."""
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+class EmbeddingStore:
+    """LRU map from keys to embeddings (numpy arrays) holding at most max_size
+    entries, with hit and miss counts. Make it with an EmbeddingStoreManager
+    to share it between processes."""
+    def __init__(self, max_size=EMB_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, keys):
+        """The embedding of each key, or None if it is not stored."""
+        with self.lock:
+            out = []
+            for key in keys:
+                emb = self.entries.get(key)
+                if emb is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                out.append(emb)
+            return out
+
+    def insert(self, keys, embs):
+        with self.lock:
+            for key, emb in zip(keys, embs):
+                self.entries[key] = emb
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+class EmbeddingStoreManager(BaseManager):
+    """Serves EmbeddingStores from a manager process:
+    manager.start(); store = manager.EmbeddingStore(max_size)."""
+    pass
+
+EmbeddingStoreManager.register("EmbeddingStore", EmbeddingStore)
+
+class EmbeddingCache:
+    """Memoizes the graph embeddings of a SkipLastGNN. Isomorphic graphs
+    (with the same anchor) have the same embedding, so embeddings are stored
+    under the canonical key of the graph and the fingerprint of the model.
+    """
+    def __init__(self, emb_model, store=None, max_size=EMB_CACHE_SIZE):
+        """
+        Args:
+            emb_model: the SkipLastGNN whose embeddings are cached; it must
+                not change while the cache is in use.
+            store: the EmbeddingStore, e.g. one shared by the processes of a
+                parallel search. By default a new one of max_size entries.
+        """
+        self.emb_model = emb_model
+        self.store = store if store is not None else EmbeddingStore(max_size)
+        self.fingerprint = model_fingerprint(emb_model)
+
+    def embed(self, keys, embed_fn):
+        """Embeddings (on the device) of the graphs with canonical keys keys.
+        The graphs missing from the store are embedded by calling embed_fn
+        with the list of their positions in keys, once."""
+        keys = [(self.fingerprint, key) for key in keys]
+        found = self.store.lookup(keys)
+        missing = [i for i, emb in enumerate(found) if emb is None]
+        if missing:
+            # a graph repeated within keys is embedded once
+            first = {}
+            for i in missing:
+                first.setdefault(keys[i], i)
+            new = embed_fn(list(first.values())).detach().cpu().numpy()
+            self.store.insert(list(first), list(new))
+            new = dict(zip(first, new))
+            for i in missing:
+                found[i] = new[keys[i]]
+        return torch.from_numpy(np.stack(found)).to(utils.get_device())
+
+    def graph_keys(self, graphs, anchors=None):
+        """Store keys of graphs, anchored at anchors. Graphs of at most
+        CANONICAL_KEY_MAX_NODES nodes are keyed by canonical form, so that
+        isomorphic graphs share an entry. Canonical forms of large graphs
+        are too costly, so those are keyed by a hash of their node and edge
+        lists (and the anchor), computed once per graph object in graphs."""
+        keys, hashes = [], {}
+        for i, graph in enumerate(graphs):
+            anchor = anchors[i] if anchors is not None else None
+            if len(graph) > CANONICAL_KEY_MAX_NODES:
+                if id(graph) not in hashes:
+                    hashes[id(graph)] = hashlib.sha1(str((list(graph.nodes),
+                        list(graph.edges))).encode()).hexdigest()
+                keys.append(("labeled", hashes[id(graph)], anchor))
+                continue
+            idx = {v: j for j, v in enumerate(graph.nodes)}
+            keys.append(canonical.canonical_key_edges(len(graph),
+                tuple(sorted(tuple(sorted((idx[u], idx[v]))) for u, v in
+                graph.edges)), frozenset([idx[anchor]]) if anchors is not
+                None else frozenset()))
+        return keys
+
+    def embed_graphs(self, graphs, anchors=None):
+        """Cached self.emb_model(utils.batch_nx_graphs(graphs, anchors))."""
+        return self.embed(self.graph_keys(graphs, anchors=anchors),
+            lambda idx: self.emb_model(utils.batch_nx_graphs([graphs[i] for i
+            in idx], anchors=[anchors[i] for i in idx] if anchors is not None
+            else None)))
+
+    def stats(self):
+        """Size of the store and its hit and miss counts."""
+        return self.store.stats()
@@ -1,4 +1,5 @@
 from collections import defaultdict, Counter
+import functools
 
 from deepsnap.graph import Graph as DSGraph
 from deepsnap.batch import Batch
@@ -7,16 +8,23 @@ import torch
 import torch.optim as optim
 import torch_geometric.utils as pyg_utils
 from torch_geometric.data import DataLoader
+from torch_geometric.data import Batch as PyGBatch
 import networkx as nx
 import numpy as np
 import random
 import scipy.stats as stats
 from tqdm import tqdm
 
+from common import canonical
 from common import feature_preprocess
+from common.graph_store import GraphStore
 
 def sample_neigh(graphs, size):
-    ps = np.array([len(g) for g in graphs], dtype=np.float)
+    """Samples a tree-structured neighborhood of size nodes from a list of
+    networkx graphs. For repeated sampling from the same graphs, build a
+    GraphStore once and use its sample_neigh, which precomputes the graph
+    choice and component size tables instead of retrying."""
+    ps = np.array([len(g) for g in graphs], dtype=float)
     ps /= np.sum(ps)
     dist = stats.rv_discrete(values=(np.arange(len(graphs)), ps))
     while True:
@@ -38,32 +46,80 @@ def sample_neigh(graphs, size):
         if len(neigh) == size:
             return graph, neigh
 
-cached_masks = None
+WL_CACHE_SIZE = 2**16
+# python's hash of an int is its residue modulo this prime (sign kept)
+HASH_MODULUS = 2**61 - 1
+
+def wl_masks(dim):
+    """The dim xor masks of vec_hash. They come from a private RNG, so
+    hashing does not disturb the global random state."""
+    rng = random.Random(2019)
+    return np.array([rng.getrandbits(32) for i in range(dim)],
+        dtype=np.int64)
+
 def vec_hash(v):
-    global cached_masks
-    if cached_masks is None:
-        random.seed(2019)
-        cached_masks = [random.getrandbits(32) for i in range(len(v))]
-    #v = [hash(tuple(v)) ^ mask for mask in cached_masks]
-    v = [hash(v[i]) ^ mask for i, mask in enumerate(cached_masks)]
-    #v = [np.sum(v) for mask in cached_masks]
-    return v
+    return [hash(v[i]) ^ int(mask) for i, mask in
+        enumerate(wl_masks(len(v)))]
+
+def hash_int64(x):
+    """hash(int(v)) for each entry v of an int64 array."""
+    neg = x < 0
+    # |x| as uint64 is exact even for the minimum int64
+    mag = np.where(neg, ~x.view(np.uint64) + np.uint64(1), x.view(np.uint64))
+    res = (mag % np.uint64(HASH_MODULUS)).astype(np.int64)
+    res[neg] *= -1
+    res[res == -1] = -2
+    return res
+
+@functools.lru_cache(maxsize=WL_CACHE_SIZE)
+def _wl_hash(n, edges, anchor, dim):
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    loops = edges[:,0] == edges[:,1]
+    # each node counts itself, and a self loop once more
+    src = np.concatenate((edges[:,0], edges[~loops,1], np.arange(n)))
+    dst = np.concatenate((edges[:,1], edges[~loops,0], np.arange(n)))
+    masks = wl_masks(dim)
+    vecs = np.zeros((n, dim), dtype=np.int64)
+    if anchor is not None:
+        vecs[anchor] = 1
+    sizes = np.ones(n, dtype=np.int64)
+    rounds = n
+    while rounds > 0:
+        # once nodes of the same color have the same number of neighbors of
+        # each color, colors stay constant on these classes and the
+        # remaining rounds can run on the quotient graph
+        _, rep, cls = np.unique(vecs, axis=0, return_index=True,
+            return_inverse=True)
+        cls = cls.reshape(-1)
+        counts = np.zeros((len(vecs), len(rep)), dtype=np.int64)
+        np.add.at(counts, (dst, cls[src]), 1)
+        if (counts == counts[rep][cls]).all():
+            sizes = np.bincount(cls, weights=sizes).astype(np.int64)
+            quotient, vecs = counts[rep], vecs[rep]
+            for i in range(rounds):
+                vecs = hash_int64(quotient.dot(vecs)) ^ masks
+            break
+        sums = np.zeros_like(vecs)
+        np.add.at(sums, dst, vecs[src])
+        vecs = hash_int64(sums) ^ masks
+        rounds -= 1
+    return tuple(sizes.dot(vecs))
 
 def wl_hash(g, dim=64, node_anchored=False):
-    g = nx.convert_node_labels_to_integers(g)
-    vecs = np.zeros((len(g), dim), dtype=np.int)
+    """Weisfeiler-Lehman hash of g: len(g) rounds in which every node's
+    vector becomes vec_hash of the sum of its own and its neighbors'
+    vectors, summed over the nodes. With node_anchored, the first node whose
+    "anchor" attribute is 1 starts from ones instead of zeros. Results are
+    cached by edge list."""
+    idx = {v: i for i, v in enumerate(g.nodes)}
+    anchor = None
     if node_anchored:
         for v in g.nodes:
             if g.nodes[v]["anchor"] == 1:
-                vecs[v] = 1
+                anchor = idx[v]
                 break
-    for i in range(len(g)):
-        newvecs = np.zeros((len(g), dim), dtype=np.int)
-        for n in g.nodes:
-            newvecs[n] = vec_hash(np.sum(vecs[list(g.neighbors(n)) + [n]],
-                axis=0))
-        vecs = newvecs
-    return tuple(np.sum(vecs, axis=0))
+    edges = tuple(sorted((idx[u], idx[v]) for u, v in g.edges))
+    return _wl_hash(len(g), edges, anchor, dim)
 
 def gen_baseline_queries_rand_esu(queries, targets, node_anchored=False):
     sizes = Counter([len(g) for g in queries])
@@ -81,9 +137,10 @@ def gen_baseline_queries_rand_esu(queries, targets, node_anchored=False):
     print(total_n_max_subgraphs, "max-size subgraphs explored")
     out = []
     for size, count in sizes.items():
-        counts = all_subgraphs[size]
-        for _, neighs in list(sorted(counts.items(), key=lambda x: len(x[1]),
-            reverse=True))[:count]:
+        # split the wl hash buckets into isomorphism classes
+        groups = [group for neighs in all_subgraphs[size].values() for group
+            in canonical.group_isomorphic(neighs, node_anchored=node_anchored)]
+        for neighs in list(sorted(groups, key=len, reverse=True))[:count]:
             print(len(neighs))
             out.append(random.choice(neighs))
     return out
@@ -143,31 +200,23 @@ def gen_baseline_queries_mfinder(queries, targets, n_samples=10000,
     #sizes = {}
     #for i in range(5, 17):
     #    sizes[i] = 10
+    store = (targets if isinstance(targets, GraphStore) else
+        GraphStore.from_networkx(targets))
     out = []
     for size, count in tqdm(sizes.items()):
         print(size)
         counts = defaultdict(list)
         for i in tqdm(range(n_samples)):
-            graph, neigh = sample_neigh(targets, size)
-            v = neigh[0]
-            neigh = graph.subgraph(neigh).copy()
+            graph_idx, neigh = store.sample_neigh(size)
+            neigh = store.to_networkx(graph_idx, neigh)
             nx.set_node_attributes(neigh, 0, name="anchor")
-            neigh.nodes[v]["anchor"] = 1
+            neigh.nodes[0]["anchor"] = 1
             neigh.remove_edges_from(nx.selfloop_edges(neigh))
             counts[wl_hash(neigh, node_anchored=node_anchored)].append(neigh)
-        #bads, t = 0, 0
-        #for ka, nas in counts.items():
-        #    for kb, nbs in counts.items():
-        #        if ka != kb:
-        #            for a in nas:
-        #                for b in nbs:
-        #                    if nx.is_isomorphic(a, b):
-        #                        bads += 1
-        #                        print("bad", bads, t)
-        #                    t += 1
-
-        for _, neighs in list(sorted(counts.items(), key=lambda x: len(x[1]),
-            reverse=True))[:count]:
+        # split the wl hash buckets into isomorphism classes
+        groups = [group for neighs in counts.values() for group in
+            canonical.group_isomorphic(neighs, node_anchored=node_anchored)]
+        for neighs in list(sorted(groups, key=len, reverse=True))[:count]:
             print(len(neighs))
             out.append(random.choice(neighs))
     return out
@@ -221,13 +270,97 @@ def build_optimizer(args, params):
     return scheduler, optimizer
 
 def batch_nx_graphs(graphs, anchors=None):
-    #motifs_batch = [pyg_utils.from_networkx(
-    #    nx.convert_node_labels_to_integers(graph)) for graph in graphs]
-    #loader = DataLoader(motifs_batch, batch_size=len(motifs_batch))
-    #for b in loader: batch = b
+    """Collates networkx graphs into a batch for SkipLastGNN.
+
+    Node i of each graph (in graph.nodes order) becomes node i of that graph's
+    block of the batch. With anchors, batch.anchor holds the batch index of
+    each graph's anchor node, and the model builds the one-hot anchor column
+    from it (see anchor_node_features); the graphs are not modified.
+    Otherwise node_feature is read from the "node_feature" node attributes if
+    present, and left to the model (all ones) if not.
+    """
+    if feature_preprocess.FEATURE_AUGMENT:
+        return batch_nx_graphs_deepsnap(graphs, anchors=anchors)
+
+    n_nodes, edges, directed_edges = [], [], []
+    anchor_idxs, features = [], []
+    offset = 0
+    for i, g in enumerate(graphs):
+        mapping = {v: j + offset for j, v in enumerate(g.nodes)}
+        (directed_edges if g.is_directed() else edges).extend(
+            (mapping[u], mapping[v]) for u, v in g.edges)
+        if anchors is not None:
+            anchor_idxs.append(mapping[anchors[i]])
+        elif len(g) > 0 and "node_feature" in g.nodes[next(iter(g.nodes))]:
+            features.append(torch.stack([g.nodes[v]["node_feature"] for v
+                in g.nodes]).view(len(g), -1))
+        else:
+            features.append(None)
+        n_nodes.append(len(g))
+        offset += len(g)
+
+    edge_index = torch.tensor(edges, dtype=torch.long).view(-1, 2).t()
+    # undirected edges are listed in both directions, as in DeepSNAP
+    edge_index = torch.cat((edge_index, edge_index.flip(0),
+        torch.tensor(directed_edges, dtype=torch.long).view(-1, 2).t()),
+        dim=1)
+    batch = PyGBatch(batch=torch.repeat_interleave(torch.tensor(n_nodes)),
+        edge_index=edge_index)
+    if anchors is not None:
+        batch.anchor = torch.tensor(anchor_idxs, dtype=torch.long)
+    elif any(f is not None for f in features):
+        batch.node_feature = torch.cat([torch.ones(n, 1) if f is None else f
+            for n, f in zip(n_nodes, features)]).float()
+    batch.G = graphs
+    batch = batch.to(get_device())
+    return batch
+
+def batch_edge_indices(neighs, anchors=None):
+    """batch_nx_graphs for graphs given as (n_nodes, edge_index) pairs, with
+    numpy edge_index arrays listing both directions of every edge (as made
+    by graph_store.radial_chunk). anchors are node ids as in
+    batch_nx_graphs."""
+    if feature_preprocess.FEATURE_AUGMENT:
+        graphs = []
+        for n_nodes, edge_index in neighs:
+            graph = nx.Graph()
+            graph.add_nodes_from(range(n_nodes))
+            graph.add_edges_from(edge_index.T.tolist())
+            graphs.append(graph)
+        return batch_nx_graphs(graphs, anchors=anchors)
+
+    n_nodes = torch.tensor([n for n, _ in neighs])
+    offsets = torch.cumsum(n_nodes, 0) - n_nodes
+    edge_index = torch.cat([torch.from_numpy(edge_index) + offset for
+        (_, edge_index), offset in zip(neighs, offsets.tolist())], dim=1)
+    batch = PyGBatch(batch=torch.repeat_interleave(n_nodes),
+        edge_index=edge_index)
+    if anchors is not None:
+        batch.anchor = offsets + torch.tensor(anchors, dtype=torch.long)
+    batch = batch.to(get_device())
+    return batch
+
+def anchor_node_features(batch):
+    """Node features of a batch from batch_nx_graphs without node_feature:
+    a column that is 1 at the anchor nodes and 0 elsewhere, or all ones if
+    the batch is not anchored."""
+    n_nodes = batch.batch.size(0)
+    anchor = getattr(batch, "anchor", None)
+    if anchor is None:
+        return torch.ones(n_nodes, 1, device=batch.batch.device)
+    x = torch.zeros(n_nodes, 1, device=batch.batch.device)
+    x[anchor] = 1
+    return x
+
+def batch_nx_graphs_deepsnap(graphs, anchors=None):
+    """batch_nx_graphs through DeepSNAP, which runs the FEATURE_AUGMENT
+    transforms on every graph."""
     augmenter = feature_preprocess.FeatureAugment()
     
     if anchors is not None:
+        # DeepSNAP reads features from node attributes; write them on copies
+        # so the caller's graphs stay untouched
+        graphs = [g.copy() for g in graphs]
         for anchor, g in zip(anchors, graphs):
             for v in g.nodes:
                 g.nodes[v]["node_feature"] = torch.tensor([float(v == anchor)])
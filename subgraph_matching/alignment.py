@@ -32,7 +32,8 @@ from subgraph_matching.config import parse_encoder
 from subgraph_matching.test import validation
 from subgraph_matching.train import build_model
 
-def gen_alignment_matrix(model, query, target, method_type="order"):
+def gen_alignment_matrix(model, query, target, method_type="order",
+    batched=True, batch_size=64, emb_cache=None):
     """Generate subgraph matching alignment matrix for a given query and
     target graph. Each entry (u, v) of the matrix contains the confidence score
     the model gives for the query graph, anchored at u, being a subgraph of the
@@ -45,8 +46,56 @@ def gen_alignment_matrix(model, query, target, method_type="order"):
         target: the target graph (networkx Graph)
         method_type: the method used for the model.
             "order" for order embedding or "mlp" for MLP model
+        batched: embed the query once per anchor u and the target once per
+            anchor v (|Q| + |T| embeddings), then score the whole grid with
+            broadcasting. Otherwise runs one forward pass per (u, v) pair.
+        batch_size: number of anchored graphs per forward pass, and number
+            of query rows scored at once, in batched mode.
+        emb_cache: optional models.EmbeddingCache of model.emb_model, for
+            callers aligning the same graphs repeatedly; in batched mode,
+            anchored graphs seen before are not embedded again (for small
+            graphs, neither are anchors in the same orbit).
     """
+    if not batched:
+        return gen_alignment_matrix_pairwise(model, query, target,
+            method_type=method_type)
 
+    with torch.no_grad():
+        emb_qs = embed_anchored(model, query, batch_size, emb_cache=emb_cache)
+        emb_ts = embed_anchored(model, target, batch_size,
+            emb_cache=emb_cache)
+        mat = []
+        for i in range(0, len(emb_qs), batch_size):
+            emb_q = emb_qs[i:i+batch_size]
+            emb_as = emb_ts.unsqueeze(0).expand(len(emb_q), -1, -1)
+            emb_bs = emb_q.unsqueeze(1).expand(-1, len(emb_ts), -1)
+            raw_pred = model.predict(model(emb_as, emb_bs))
+            if method_type == "order":
+                raw_pred = torch.log(raw_pred)
+            elif method_type == "mlp":
+                raw_pred = raw_pred[:,:,1]
+            mat.append(raw_pred.cpu())
+    return torch.cat(mat, dim=0).double().numpy()
+
+def embed_anchored(model, graph, batch_size, emb_cache=None):
+    """Embed graph once anchored at each of its nodes, in graph.nodes order.
+    """
+    nodes = list(graph.nodes)
+    embs = []
+    for i in range(0, len(nodes), batch_size):
+        anchors = nodes[i:i+batch_size]
+        if emb_cache is not None:
+            embs.append(emb_cache.embed_graphs([graph] * len(anchors),
+                anchors=anchors))
+            continue
+        batch = utils.batch_nx_graphs([graph] * len(anchors),
+            anchors=anchors)
+        embs.append(model.emb_model(batch))
+    return torch.cat(embs, dim=0)
+
+def gen_alignment_matrix_pairwise(model, query, target, method_type="order"):
+    """Reference implementation of gen_alignment_matrix: one forward pass
+    per (u, v) anchor pair."""
     mat = np.zeros((len(query), len(target)))
     for i, u in enumerate(query.nodes):
         for j, v in enumerate(target.nodes):
@@ -74,6 +123,8 @@ def main():
         default="")
     parser.add_argument('--target_path', type=str, help='path of target graph',
         default="")
+    parser.add_argument('--pairwise', action="store_true",
+        help='run one forward pass per anchor pair instead of batching')
     args = parser.parse_args()
     args.test = True
     if args.query_path:
@@ -88,8 +139,10 @@ def main():
         target = nx.gnp_random_graph(16, 0.25)
 
     model = build_model(args)
+    model.eval()
     mat = gen_alignment_matrix(model, query, target,
-        method_type=args.method_type)
+        method_type=args.method_type, batched=not args.pairwise,
+        batch_size=args.batch_size)
 
     np.save("results/alignment.npy", mat)
     print("Saved alignment matrix in results/alignment.npy")
@@ -31,6 +31,8 @@ def parse_encoder(parser, arg_str=None):
                         help='how often to eval during training')
     enc_parser.add_argument('--val_size', type=int,
                         help='validation set size')
+    enc_parser.add_argument('--val_seed', type=int,
+                        help='seed of the validation set (and dataset split)')
     enc_parser.add_argument('--model_path', type=str,
                         help='path to save/load model')
     enc_parser.add_argument('--opt_scheduler', type=str,
@@ -63,6 +65,7 @@ def parse_encoder(parser, arg_str=None):
                         model_path="ckpt/model.pt",
                         tag='',
                         val_size=4096,
+                        val_seed=0,
                         node_anchored=True)
 
     #return enc_parser.parse_args(arg_str)
@@ -41,6 +41,8 @@ def parse_encoder(parser):
                         help='how often to eval during training')
     parser.add_argument('--val_size', type=int,
                         help='validation set size')
+    parser.add_argument('--val_seed', type=int,
+                        help='seed of the validation set (and dataset split)')
     parser.add_argument('--model_path', type=str,
                         help='path to save/load model')
     parser.add_argument('--start_weights', type=str,
@@ -79,4 +81,5 @@ def parse_encoder(parser):
                         model_path="ckpt/model.pt",
                         tag='',
                         val_size=4096,
+                        val_seed=0,
                         node_anchored=True)
@@ -3,6 +3,7 @@ from collections import defaultdict
 from datetime import datetime
 from sklearn.metrics import roc_auc_score, confusion_matrix
 from sklearn.metrics import precision_recall_curve, average_precision_score
+import numpy as np
 import torch
 
 USE_ORCA_FEATS = False # whether to use orca motif counts along with embeddings
@@ -35,16 +36,18 @@ def validation(args, model, test_pts, logger, batch_n, epoch, verbose=False):
             if USE_ORCA_FEATS:
                 import orca
                 import matplotlib.pyplot as plt
-                def make_feats(g):
+                def make_feats(g, anchor):
                     counts5 = np.array(orca.orbit_counts("node", 5, g))
-                    for v, n in zip(counts5, g.nodes):
-                        if g.nodes[n]["node_feature"][0] > 0:
-                            anchor_v = v
-                            break
+                    anchor_v = counts5[anchor]
                     v5 = np.sum(counts5, axis=0)
                     return v5, anchor_v
-                for i, (ga, gb) in enumerate(zip(neg_a.G, neg_b.G)):
-                    (va, na), (vb, nb) = make_feats(ga), make_feats(gb)
+                def local_anchors(batch):
+                    starts = np.cumsum([0] + [len(g) for g in batch.G])[:-1]
+                    return batch.anchor.cpu().numpy() - starts
+                for i, (ga, gb, anchor_a, anchor_b) in enumerate(zip(neg_a.G,
+                    neg_b.G, local_anchors(neg_a), local_anchors(neg_b))):
+                    (va, na), (vb, nb) = (make_feats(ga, anchor_a),
+                        make_feats(gb, anchor_b))
                     if (va < vb).any() or (na < nb).any():
                         raw_pred[pos_a.num_graphs + i] = MAX_MARGIN_SCORE
 
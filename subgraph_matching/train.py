@@ -30,6 +30,7 @@ import torch_geometric.utils as pyg_utils
 import torch_geometric.nn as pyg_nn
 
 from common import data
+from common import feature_preprocess
 from common import models
 from common import utils
 if HYPERPARAM_SEARCH:
@@ -63,16 +64,65 @@ def make_data_source(args):
         else:
             raise Exception("Error: unrecognized dataset")
     else:
+        # fixed split, so that the cached validation set stays held out
         if len(toks) == 1 or toks[1] == "balanced":
             data_source = data.DiskDataSource(toks[0],
-                node_anchored=args.node_anchored)
+                node_anchored=args.node_anchored, split_seed=args.val_seed)
         elif toks[1] == "imbalanced":
             data_source = data.DiskImbalancedDataSource(toks[0],
-                node_anchored=args.node_anchored)
+                node_anchored=args.node_anchored, split_seed=args.val_seed)
         else:
             raise Exception("Error: unrecognized dataset")
     return data_source
 
+def make_validation_set(args, data_source):
+    """Validation batches for train_loop, sampled with seed args.val_seed.
+
+    The collated batches are saved under data.VAL_CACHE_DIR on first use and
+    memory-mapped by later runs with the same dataset, sizes, anchoring,
+    val_size, batch_size and seed.
+    """
+    key = "{}-{}-{}-{}-{}-{}-{}".format(args.dataset, data_source.min_size,
+        data_source.max_size, "anchored" if args.node_anchored else
+        "unanchored", args.val_size, args.batch_size, args.val_seed)
+    path = os.path.join(data.VAL_CACHE_DIR, "{}-v{}".format(key,
+        data.VAL_CACHE_VERSION))
+    if os.path.exists(os.path.join(path, "sizes.npy")):
+        print("loaded validation set", path)
+        return data.load_batches(path)
+
+    rng_state = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(args.val_seed)
+    np.random.seed(args.val_seed)
+    torch.manual_seed(args.val_seed)
+    loaders = data_source.gen_data_loaders(args.val_size, args.batch_size,
+        train=False, use_distributed_sampling=False)
+    test_pts = []
+    for batch_target, batch_neg_target, batch_neg_query in zip(*loaders):
+        pos_a, pos_b, neg_a, neg_b = data_source.gen_batch(batch_target,
+            batch_neg_target, batch_neg_query, False)
+        if pos_a:
+            pos_a = pos_a.to(torch.device("cpu"))
+            pos_b = pos_b.to(torch.device("cpu"))
+        neg_a = neg_a.to(torch.device("cpu"))
+        neg_b = neg_b.to(torch.device("cpu"))
+        test_pts.append((pos_a, pos_b, neg_a, neg_b))
+    random.setstate(rng_state[0])
+    np.random.set_state(rng_state[1])
+    torch.set_rng_state(rng_state[2])
+    # e.g. the label store's connection and pool, which the training
+    # workers could not be spawned with
+    data_source.close()
+
+    # feature-augmented batches carry features that save_batches drops
+    if not feature_preprocess.FEATURE_AUGMENT:
+        data.save_batches(path, test_pts)
+        print("saved validation set", path)
+        # read back, so that the batches have networkx graphs (batch.G) for
+        # validation even when the data source collated them without
+        return data.load_batches(path)
+    return test_pts
+
 def train(args, model, logger, in_queue, out_queue):
     """Train the order embedding model.
 
@@ -88,18 +138,19 @@ def train(args, model, logger, in_queue, out_queue):
     done = False
     while not done:
         data_source = make_data_source(args)
-        loaders = data_source.gen_data_loaders(args.eval_interval *
+        batches = data_source.gen_batches(args.eval_interval *
             args.batch_size, args.batch_size, train=True)
-        for batch_target, batch_neg_target, batch_neg_query in zip(*loaders):
+        for batch in batches:
             msg, _ = in_queue.get()
             if msg == "done":
+                batches.close()
                 done = True
                 break
             # train
             model.train()
             model.zero_grad()
-            pos_a, pos_b, neg_a, neg_b = data_source.gen_batch(batch_target,
-                batch_neg_target, batch_neg_query, True)
+            pos_a, pos_b, neg_a, neg_b = [b.to(utils.get_device()) for b in
+                batch]
             emb_pos_a, emb_pos_b = model.emb_model(pos_a), model.emb_model(pos_b)
             emb_neg_a, emb_neg_b = model.emb_model(neg_a), model.emb_model(neg_b)
             #print(emb_pos_a.shape, emb_neg_a.shape, emb_neg_b.shape)
@@ -158,18 +209,7 @@ def train_loop(args):
         clf_opt = None
 
     data_source = make_data_source(args)
-    loaders = data_source.gen_data_loaders(args.val_size, args.batch_size,
-        train=False, use_distributed_sampling=False)
-    test_pts = []
-    for batch_target, batch_neg_target, batch_neg_query in zip(*loaders):
-        pos_a, pos_b, neg_a, neg_b = data_source.gen_batch(batch_target,
-            batch_neg_target, batch_neg_query, False)
-        if pos_a:
-            pos_a = pos_a.to(torch.device("cpu"))
-            pos_b = pos_b.to(torch.device("cpu"))
-        neg_a = neg_a.to(torch.device("cpu"))
-        neg_b = neg_b.to(torch.device("cpu"))
-        test_pts.append((pos_a, pos_b, neg_a, neg_b))
+    test_pts = make_validation_set(args, data_source)
 
     workers = []
     for i in range(args.n_workers):
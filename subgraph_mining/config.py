@@ -26,8 +26,32 @@ def parse_decoder(parser):
     dec_parser.add_argument('--analyze', action="store_true")
     dec_parser.add_argument('--search_strategy', type=str,
                         help='"greedy" or "mcts"')
+    dec_parser.add_argument('--n_search_workers', type=int,
+                        help='processes for greedy search, threads for mcts '
+                        '(0: none)')
+    dec_parser.add_argument('--search_seed', type=int,
+                        help='seed of the greedy search shards')
     dec_parser.add_argument('--use_whole_graphs', action="store_true",
         help="whether to cluster whole graphs or sampled node neighborhoods")
+    dec_parser.add_argument('--resume', action="store_true",
+        help="continue the search from the checkpoint next to out_path")
+    dec_parser.add_argument('--no_plots', dest="plot", action="store_false",
+        help="do not draw the output patterns")
+    dec_parser.add_argument('--no_neigh_cache', dest="neigh_cache",
+        action="store_false",
+        help="resample the neighborhoods instead of reusing a stored sample")
+    dec_parser.add_argument('--progressive_scoring', action="store_true",
+        help="greedy search: score candidates on growing samples of the "
+        "neighborhoods until the best ones are known")
+    dec_parser.add_argument('--scoring_error_prob', type=float,
+                        help='with --progressive_scoring, probability of '
+                        'keeping different beams than exhaustive scoring')
+    dec_parser.add_argument('--emb_cache_size', type=int,
+                        help='number of pattern embeddings memoized during '
+                        'the search (0: none)')
+    dec_parser.add_argument('--neigh_emb_dtype', type=str,
+                        help='"float32" or "float16" storage of neighborhood '
+                        'embeddings')
 
     dec_parser.set_defaults(out_path="results/out-patterns.p",
                         n_neighborhoods=10000,
@@ -42,6 +66,15 @@ def parse_decoder(parser):
                         min_neighborhood_size=20,
                         max_neighborhood_size=29,
                         search_strategy="greedy",
+                        n_search_workers=0,
+                        progressive_scoring=False,
+                        scoring_error_prob=0.05,
+                        emb_cache_size=2**16,
+                        search_seed=0,
+                        resume=False,
+                        plot=True,
+                        neigh_cache=True,
+                        neigh_emb_dtype="float32",
                         out_batch_size=10,
                         node_anchored=True)
 
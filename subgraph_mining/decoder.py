@@ -1,6 +1,8 @@
 import argparse
 import csv
+import hashlib
 from itertools import combinations
+import itertools
 import time
 import os
 
@@ -21,9 +23,11 @@ import torch_geometric.nn as pyg_nn
 from matplotlib import cm
 
 from common import data
+from common import graph_store
 from common import models
 from common import utils
 from common import combined_syn
+from common.graph_store import GraphStore
 from subgraph_mining.config import parse_decoder
 from subgraph_matching.config import parse_encoder
 from subgraph_mining.search_agents import GreedySearchAgent, MCTSSearchAgent
@@ -73,6 +77,69 @@ def make_plant_dataset(size):
         graphs.append(graph)
     return graphs
 
+def neighborhood_cache_path(task, args):
+    """Directory of the neighborhood store of a run: keyed by the dataset,
+    the model checkpoint and every argument that affects the sampled
+    neighborhoods or their embeddings."""
+    params = [args.dataset, task, data.file_hash(args.model_path),
+        args.method_type, args.use_whole_graphs, args.sample_method,
+        args.node_anchored, args.neigh_emb_dtype]
+    if args.sample_method == "radial":
+        params += [args.radius, args.subgraph_sample_size]
+    else:
+        params += [args.n_neighborhoods, args.min_neighborhood_size,
+            args.max_neighborhood_size]
+    key = hashlib.sha1(str(params).encode()).hexdigest()[:16]
+    return os.path.join(data.NEIGH_CACHE_DIR, "{}-{}-v{}".format(
+        args.dataset, key, data.NEIGH_CACHE_VERSION))
+
+def embed_neighborhoods(model, store, path, args):
+    """Samples the node neighborhoods of the graphs in store and embeds them
+    args.batch_size at a time. Both are saved to a neighborhood store at
+    path (unless args.neigh_cache is off) for later runs; the neighborhoods
+    are written as they are sampled rather than kept.
+
+    Returns: list of embedding batches.
+    """
+    if args.use_whole_graphs:
+        neighs = (store.neighborhood(i, np.arange(store.num_nodes(i)),
+            center_loop=False) for i in range(len(store)))
+    elif args.sample_method == "radial":
+        # centered and anchored at node 0, streamed from the worker
+        # processes
+        neighs = graph_store.radial_neighborhoods(store, args.radius,
+            sample_size=args.subgraph_sample_size, n_workers=args.n_workers)
+    elif args.sample_method == "tree":
+        neighs = (store.neighborhood(*store.sample_neigh(random.randint(
+            args.min_neighborhood_size, args.max_neighborhood_size))) for j
+            in tqdm(range(args.n_neighborhoods)))
+
+    embs = []
+    writer = data.NeighborhoodWriter(path) if args.neigh_cache else None
+    neighs = iter(neighs)
+    while True:
+        chunk = list(itertools.islice(neighs, args.batch_size))
+        if not chunk:
+            break
+        # 0 is the anchor
+        anchors = [0]*len(chunk) if args.node_anchored else None
+        with torch.no_grad():
+            emb = model.emb_model(utils.batch_edge_indices(chunk,
+                anchors=anchors))
+            emb = emb.to(torch.device("cpu"))
+        embs.append(emb)
+        if writer is not None:
+            writer.add(chunk)
+
+    if writer is not None:
+        writer.close(torch.cat(embs).numpy().astype(args.neigh_emb_dtype))
+        print("saved neighborhood embeddings", path)
+        if args.neigh_emb_dtype != "float32":
+            # search with the stored precision, as later runs will
+            embs = [emb.to(getattr(torch, args.neigh_emb_dtype)).float() for
+                emb in embs]
+    return embs
+
 def pattern_growth(dataset, task, args):
     # init model
     if args.method_type == "end2end":
@@ -90,92 +157,91 @@ def pattern_growth(dataset, task, args):
         dataset, labels = dataset
 
     # load data
-    neighs_pyg, neighs = [], []
     print(len(dataset), "graphs")
     print("search strategy:", args.search_strategy)
     if task == "graph-labeled": print("using label 0")
-    graphs = []
-    for i, graph in enumerate(dataset):
-        if task == "graph-labeled" and labels[i] != 0: continue
-        if task == "graph-truncate" and i >= 1000: break
-        if not type(graph) == nx.Graph:
-            graph = pyg_utils.to_networkx(graph).to_undirected()
-        graphs.append(graph)
-    if args.use_whole_graphs:
-        neighs = graphs
+    if isinstance(dataset, GraphStore):
+        # memory-mapped single graphs from data.load_edge_list
+        store = dataset
     else:
-        anchors = []
-        if args.sample_method == "radial":
-            for i, graph in enumerate(graphs):
-                print(i)
-                for j, node in enumerate(graph.nodes):
-                    if len(dataset) <= 10 and j % 100 == 0: print(i, j)
-                    if args.use_whole_graphs:
-                        neigh = graph.nodes
-                    else:
-                        neigh = list(nx.single_source_shortest_path_length(graph,
-                            node, cutoff=args.radius).keys())
-                        if args.subgraph_sample_size != 0:
-                            neigh = random.sample(neigh, min(len(neigh),
-                                args.subgraph_sample_size))
-                    if len(neigh) > 1:
-                        neigh = graph.subgraph(neigh)
-                        if args.subgraph_sample_size != 0:
-                            neigh = neigh.subgraph(max(
-                                nx.connected_components(neigh), key=len))
-                        neigh = nx.convert_node_labels_to_integers(neigh)
-                        neigh.add_edge(0, 0)
-                        neighs.append(neigh)
-        elif args.sample_method == "tree":
-            start_time = time.time()
-            for j in tqdm(range(args.n_neighborhoods)):
-                graph, neigh = utils.sample_neigh(graphs,
-                    random.randint(args.min_neighborhood_size,
-                        args.max_neighborhood_size))
-                neigh = graph.subgraph(neigh)
-                neigh = nx.convert_node_labels_to_integers(neigh)
-                neigh.add_edge(0, 0)
-                neighs.append(neigh)
-                if args.node_anchored:
-                    anchors.append(0)   # after converting labels, 0 will be anchor
-
-    embs = []
-    if len(neighs) % args.batch_size != 0:
-        print("WARNING: number of graphs not multiple of batch size")
-    for i in range(len(neighs) // args.batch_size):
-        #top = min(len(neighs), (i+1)*args.batch_size)
-        top = (i+1)*args.batch_size
-        with torch.no_grad():
-            batch = utils.batch_nx_graphs(neighs[i*args.batch_size:top],
-                anchors=anchors if args.node_anchored else None)
-            emb = model.emb_model(batch)
-            emb = emb.to(torch.device("cpu"))
-
-        embs.append(emb)
+        graphs = []
+        for i, graph in enumerate(dataset):
+            if task == "graph-labeled" and labels[i] != 0: continue
+            if task == "graph-truncate" and i >= 1000: break
+            if not type(graph) == nx.Graph:
+                graph = pyg_utils.to_networkx(graph).to_undirected()
+            graphs.append(graph)
+        store = GraphStore.from_networkx(graphs)
+    start_time = time.time()
+    path = neighborhood_cache_path(task, args)
+    cached = data.load_neighborhoods(path) if args.neigh_cache else None
+    if cached is not None:
+        print("loaded neighborhood embeddings", path)
+        # copied out of the read-only memory map
+        embs = [torch.from_numpy(np.array(cached[-1], dtype=np.float32))]
+    else:
+        embs = embed_neighborhoods(model, store, path, args)
 
     if args.analyze:
-        embs_np = torch.stack(embs).numpy()
+        embs_np = torch.cat(embs).numpy()
         plt.scatter(embs_np[:,0], embs_np[:,1], label="node neighborhood")
 
+    emb_cache = None
+    if args.emb_cache_size > 0:
+        if args.search_strategy == "greedy" and args.n_search_workers > 0:
+            # one store for all the search processes
+            manager = models.EmbeddingStoreManager()
+            manager.start()
+            emb_cache = models.EmbeddingCache(model.emb_model,
+                store=manager.EmbeddingStore(args.emb_cache_size))
+        else:
+            emb_cache = models.EmbeddingCache(model.emb_model,
+                max_size=args.emb_cache_size)
     if args.search_strategy == "mcts":
         assert args.method_type == "order"
         agent = MCTSSearchAgent(args.min_pattern_size, args.max_pattern_size,
-            model, graphs, embs, node_anchored=args.node_anchored,
-            analyze=args.analyze, out_batch_size=args.out_batch_size)
+            model, store, embs, node_anchored=args.node_anchored,
+            analyze=args.analyze, out_batch_size=args.out_batch_size,
+            n_threads=max(1, args.n_search_workers), emb_cache=emb_cache)
     elif args.search_strategy == "greedy":
         agent = GreedySearchAgent(args.min_pattern_size, args.max_pattern_size,
-            model, graphs, embs, node_anchored=args.node_anchored,
+            model, store, embs, node_anchored=args.node_anchored,
             analyze=args.analyze, model_type=args.method_type,
-            out_batch_size=args.out_batch_size)
-    out_graphs = agent.run_search(args.n_trials)
+            out_batch_size=args.out_batch_size,
+            n_workers=args.n_search_workers, seed=args.search_seed,
+            emb_cache=emb_cache, progressive=args.progressive_scoring,
+            error_prob=args.scoring_error_prob)
+    if not os.path.exists(os.path.dirname(args.out_path) or "."):
+        os.makedirs(os.path.dirname(args.out_path))
+    # finished sizes are appended to the .partial file as the search goes,
+    # and the search state is checkpointed for --resume
+    out_graphs = agent.run_search(args.n_trials,
+        checkpoint_path=args.out_path + ".ckpt", resume=args.resume,
+        stream_path=args.out_path + ".partial")
     print(time.time() - start_time, "TOTAL TIME")
     x = int(time.time() - start_time)
     print(x // 60, "mins", x % 60, "secs")
+    if emb_cache is not None:
+        print("pattern embedding cache:", emb_cache.stats())
+
+    with open(args.out_path, "wb") as f:
+        pickle.dump(out_graphs, f)
+    # the checkpoint is not written if no size was ever output
+    for progress_path in [args.out_path + ".partial", args.out_path +
+        ".ckpt"]:
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+
+    if args.plot:
+        # in the background, the output is already saved
+        mp.Process(target=plot_patterns, args=(out_graphs,
+            args.node_anchored)).start()
 
-    # visualize out patterns
+def plot_patterns(out_graphs, node_anchored):
+    """Draws each pattern into plots/cluster/{size}-{i}.png and .pdf."""
     count_by_size = defaultdict(int)
     for pattern in out_graphs:
-        if args.node_anchored:
+        if node_anchored:
             colors = ["red"] + ["blue"]*(len(pattern)-1)
             nx.draw(pattern, node_color=colors, with_labels=True)
         else:
@@ -189,11 +255,6 @@ def pattern_growth(dataset, task, args):
         plt.close()
         count_by_size[len(pattern)] += 1
 
-    if not os.path.exists("results"):
-        os.makedirs("results")
-    with open(args.out_path, "wb") as f:
-        pickle.dump(out_graphs, f)
-
 def main():
     if not os.path.exists("plots/cluster"):
         os.makedirs("plots/cluster")
@@ -205,45 +266,24 @@ def main():
     args.dataset = "enzymes"
 
     print("Using dataset {}".format(args.dataset))
-    if args.dataset == 'enzymes':
-        dataset = TUDataset(root='/tmp/ENZYMES', name='ENZYMES')
-        task = 'graph'
-    elif args.dataset == 'cox2':
-        dataset = TUDataset(root='/tmp/cox2', name='COX2')
-        task = 'graph'
-    elif args.dataset == 'reddit-binary':
-        dataset = TUDataset(root='/tmp/REDDIT-BINARY', name='REDDIT-BINARY')
+    if args.dataset in ['enzymes', 'cox2', 'reddit-binary', 'coil']:
+        dataset = data.load_graphs(args.dataset)
         task = 'graph'
     elif args.dataset == 'dblp':
-        dataset = TUDataset(root='/tmp/dblp', name='DBLP_v1')
+        dataset = data.load_graphs(args.dataset)
         task = 'graph-truncate'
-    elif args.dataset == 'coil':
-        dataset = TUDataset(root='/tmp/coil', name='COIL-DEL')
-        task = 'graph'
     elif args.dataset.startswith('roadnet-'):
-        graph = nx.Graph()
-        with open("data/{}.txt".format(args.dataset), "r") as f:
-            for row in f:
-                if not row.startswith("#"):
-                    a, b = row.split("\t")
-                    graph.add_edge(int(a), int(b))
-        dataset = [graph]
+        dataset = data.load_edge_list("data/{}.txt".format(args.dataset))
         task = 'graph'
     elif args.dataset == "ppi":
-        dataset = PPI(root="/tmp/PPI")
+        dataset = data.load_graphs(args.dataset)
         task = 'graph'
     elif args.dataset in ['diseasome', 'usroads', 'mn-roads', 'infect']:
         fn = {"diseasome": "bio-diseasome.mtx",
             "usroads": "road-usroads.mtx",
             "mn-roads": "mn-roads.mtx",
             "infect": "infect-dublin.edges"}
-        graph = nx.Graph()
-        with open("data/{}".format(fn[args.dataset]), "r") as f:
-            for line in f:
-                if not line.strip(): continue
-                a, b = line.strip().split(" ")
-                graph.add_edge(int(a), int(b))
-        dataset = [graph]
+        dataset = data.load_edge_list("data/{}".format(fn[args.dataset]))
         task = 'graph'
     elif args.dataset.startswith('plant-'):
         size = int(args.dataset.split("-")[-1])
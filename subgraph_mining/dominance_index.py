@@ -0,0 +1,158 @@
+"""Index over neighborhood embeddings for scoring candidate patterns.
+
+The order embedding violation of a pattern embedding q against a
+neighborhood embedding a is sum_i max(0, q_i - a_i)^2. Scoring a pattern
+counts the neighborhoods with violation below a threshold (greedy search) or
+sums the violations (MCTS). Both are done here without a full scan.
+
+The sum is separable over dimensions: in dimension i it is
+k q_i^2 - 2 q_i S_1 + S_2, where k is the number of embeddings with a_i < q_i
+and S_1, S_2 are the sums of their a_i and a_i^2. With each dimension sorted
+and its prefix sums stored, the sum takes a binary search per dimension.
+
+For counts, the embeddings are split by a kd-tree into leaves of at most
+leaf_size points, and each leaf keeps the bounding box [lo, hi] of its
+points. Over the box the violation lies between sum max(0, q - hi)^2 and
+sum max(0, q - lo)^2, so a leaf whose bounds fall on one side of the
+threshold is counted (or skipped) as a whole. Only the other leaves are
+scanned, which keeps the counts exact. Order embeddings of neighborhoods are
+strongly correlated across dimensions, so the boxes are tight and most
+leaves are decided by their bounds.
+"""
+import numpy as np
+import torch
+
+def kd_leaves(embs, leaf_size):
+    """Order of the rows of embs (numpy array) grouped into kd-tree leaves
+    of at most leaf_size rows, and the start of each leaf in that order.
+    Each split is at the median of the dimension of largest spread."""
+    order, starts = [], []
+    stack = [np.arange(len(embs))]
+    while stack:
+        idx = stack.pop()
+        if len(idx) <= leaf_size:
+            starts.append(len(order))
+            order.extend(idx.tolist())
+            continue
+        pts = embs[idx]
+        dim = np.argmax(pts.max(axis=0) - pts.min(axis=0))
+        half = len(idx) // 2
+        part = np.argpartition(pts[:, dim], half)
+        # pushed in reverse so that leaves come out left to right
+        stack.append(idx[part[half:]])
+        stack.append(idx[part[:half]])
+    return np.array(order, dtype=np.int64), np.array(starts, dtype=np.int64)
+
+class DominanceIndex:
+    """Counts and sums of the violations of queries against a fixed set of
+    embeddings."""
+    def __init__(self, embs, leaf_size=256, chunk_size=2**20):
+        """
+        Args:
+            embs: (n, d) tensor of neighborhood embeddings. The index lives
+                on its device.
+            leaf_size: max number of embeddings per leaf.
+            chunk_size: max number of (query, embedding) or (query, leaf)
+                pairs compared in one device op.
+        """
+        self.n_embs = len(embs)
+        self.chunk_size = chunk_size
+        device = embs.device
+        order, starts = kd_leaves(embs.detach().cpu().numpy(), leaf_size)
+        sizes = np.diff(np.append(starts, len(order)))
+        # leaves padded to leaf_size rows; valid marks the real rows
+        rows = np.arange(leaf_size)
+        valid = rows[None, :] < sizes[:, None]
+        pos = np.where(valid, starts[:, None] + rows[None, :], 0)
+        self.leaves = embs[torch.from_numpy(order[pos]).to(device)]
+        self.valid = torch.from_numpy(valid).to(device)
+        self.leaf_sizes = torch.from_numpy(sizes).to(device)
+        big = torch.tensor(float("inf"), device=device)
+        self.lo = torch.where(self.valid.unsqueeze(-1), self.leaves,
+            big).min(dim=1)[0]
+        self.hi = torch.where(self.valid.unsqueeze(-1), self.leaves,
+            -big).max(dim=1)[0]
+        # (d, n) sorted dimensions and their prefix sums, in float64 since
+        # sum_violations subtracts them; CPU tensors, for share_memory
+        cols = np.sort(embs.detach().cpu().numpy().astype(np.float64).T,
+            axis=1)
+        zeros = np.zeros((len(cols), 1))
+        self.cols = torch.from_numpy(cols)
+        self.prefix = torch.from_numpy(np.concatenate((zeros, np.cumsum(cols,
+            axis=1)), axis=1))
+        self.prefix_sq = torch.from_numpy(np.concatenate((zeros, np.cumsum(
+            cols**2, axis=1)), axis=1))
+
+    def __len__(self):
+        return self.n_embs
+
+    def share_memory(self):
+        """Moves the CPU tensors of the index to shared memory, so that
+        processes it is sent to use it without a copy. Returns self."""
+        for tensor in [self.leaves, self.valid, self.leaf_sizes, self.lo,
+            self.hi, self.cols, self.prefix, self.prefix_sq]:
+            tensor.share_memory_()
+        return self
+
+    def leaf_bounds(self, queries):
+        """(queries x leaves) lower and upper bounds of the violation of
+        each query against the embeddings of each leaf."""
+        lower = torch.sum(torch.clamp(queries.unsqueeze(1) -
+            self.hi.unsqueeze(0), min=0)**2, dim=-1)
+        upper = torch.sum(torch.clamp(queries.unsqueeze(1) -
+            self.lo.unsqueeze(0), min=0)**2, dim=-1)
+        return lower, upper
+
+    def scan(self, queries, query_idx, leaf_idx):
+        """Violations (pairs x leaf_size) of queries[query_idx] against the
+        embeddings of the leaves leaf_idx, and the mask of real entries."""
+        viol = torch.sum(torch.clamp(queries[query_idx].unsqueeze(1) -
+            self.leaves[leaf_idx], min=0)**2, dim=-1)
+        return viol, self.valid[leaf_idx]
+
+    def reduce(self, queries, leaf_fn, scan_fn):
+        """Sums over leaves for each query: leaf_fn(lower, upper) gives the
+        value of every (query, leaf) pair decided by its bounds (and NaN for
+        the others), scan_fn(viol, valid) that of the scanned pairs."""
+        total = torch.zeros(len(queries), device=queries.device)
+        n_leaves, leaf_size = self.valid.shape
+        query_chunk = max(1, self.chunk_size // max(1, n_leaves))
+        pair_chunk = max(1, self.chunk_size // leaf_size)
+        for i in range(0, len(queries), query_chunk):
+            q = queries[i:i+query_chunk]
+            value = leaf_fn(*self.leaf_bounds(q))
+            open_pairs = torch.isnan(value)
+            total[i:i+len(q)] += torch.sum(torch.where(open_pairs,
+                torch.zeros_like(value), value), dim=1)
+            query_idx, leaf_idx = open_pairs.nonzero().t()
+            for j in range(0, len(query_idx), pair_chunk):
+                viol, valid = self.scan(q, query_idx[j:j+pair_chunk],
+                    leaf_idx[j:j+pair_chunk])
+                total.index_add_(0, i + query_idx[j:j+pair_chunk],
+                    scan_fn(viol, valid))
+        return total
+
+    def count_below(self, queries, thresh, strict=True):
+        """Number of embeddings whose violation against each query is below
+        thresh (at most thresh if not strict)."""
+        sizes = self.leaf_sizes.float().unsqueeze(0)
+        below = (lambda v: v < thresh) if strict else (lambda v: v <= thresh)
+        def leaf_fn(lower, upper):
+            value = torch.full_like(lower, float("nan"))
+            value[~below(lower)] = 0
+            value = torch.where(below(upper), sizes.expand_as(value), value)
+            return value
+        return self.reduce(queries, leaf_fn, lambda viol, valid: torch.sum(
+            (below(viol) & valid).float(), dim=1))
+
+    def sum_violations(self, queries):
+        """Sum of the violations of each query against all embeddings."""
+        q = queries.detach().cpu().numpy().astype(np.float64)
+        cols, prefix, prefix_sq = (self.cols.numpy(), self.prefix.numpy(),
+            self.prefix_sq.numpy())
+        total = np.zeros(len(q))
+        for i, col in enumerate(cols):
+            k = np.searchsorted(col, q[:, i])
+            total += (k * q[:, i]**2 - 2 * q[:, i] * prefix[i, k] +
+                prefix_sq[i, k])
+        return torch.from_numpy(total).float().to(queries.device)
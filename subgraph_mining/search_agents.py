@@ -17,10 +17,13 @@ import torch_geometric.utils as pyg_utils
 import torch_geometric.nn as pyg_nn
 from matplotlib import cm
 
+from common import canonical
 from common import data
 from common import models
 from common import utils
 from common import combined_syn
+from common.graph_store import GraphStore
+from subgraph_mining import dominance_index
 from subgraph_mining.config import parse_decoder
 from subgraph_matching.config import parse_encoder
 
@@ -37,9 +40,33 @@ from queue import PriorityQueue
 import matplotlib.colors as mcolors
 import networkx as nx
 import pickle
+import heapq
+import threading
 import torch.multiprocessing as mp
 from sklearn.decomposition import PCA
 
+# max number of (candidate, neighborhood) pairs scored in one device op
+SCORE_CHUNK_SIZE = 2**20
+# max number of floats of intermediate values over (candidate, neighborhood)
+# pairs held at once by reduce_over_neighs
+SCORE_CHUNK_FLOATS = 2**25
+# max number of candidate patterns embedded in one forward pass
+CAND_BATCH_SIZE = 1024
+
+def plain_dicts(obj):
+    """obj with nested defaultdicts turned into dicts, for pickling."""
+    if isinstance(obj, defaultdict):
+        return {k: plain_dicts(v) for k, v in obj.items()}
+    return obj
+
+def merge_dicts(target, saved):
+    """Inverse of plain_dicts: fills defaultdict target from dict saved."""
+    for k, v in saved.items():
+        if isinstance(target[k], defaultdict):
+            merge_dicts(target[k], v)
+        else:
+            target[k] = v
+
 class SearchAgent:
     """ Class for search strategies to identify frequent subgraphs in embedding space.
 
@@ -51,14 +78,14 @@ class SearchAgent:
     """
     def __init__(self, min_pattern_size, max_pattern_size, model, dataset,
         embs, node_anchored=False, analyze=False, model_type="order",
-        out_batch_size=20):
+        out_batch_size=20, emb_cache=None):
         """ Subgraph pattern search by walking in embedding space.
 
         Args:
             min_pattern_size: minimum size of frequent subgraphs to be identified.
             max_pattern_size: maximum size of frequent subgraphs to be identified.
             model: the trained subgraph matching model (PyTorch nn.Module).
-            dataset: the DeepSNAP dataset for which to mine the frequent subgraph pattern.
+            dataset: the GraphStore of graphs in which to mine the frequent subgraph pattern.
             embs: embeddings of sampled node neighborhoods (see paper).
             node_anchored: an option to specify whether to identify node_anchored subgraph patterns.
                 node_anchored search procedure has to use a node_anchored model (specified in subgraph
@@ -67,6 +94,8 @@ class SearchAgent:
             model_type: type of the subgraph matching model (requires to be consistent with the model parameter).
             out_batch_size: the number of frequent subgraphs output by the mining algorithm for each size.
                 They are predicted to be the out_batch_size most frequent subgraphs in the dataset.
+            emb_cache: optional models.EmbeddingCache of model.emb_model, so
+                that patterns seen before are not embedded again.
         """
         self.min_pattern_size = min_pattern_size
         self.max_pattern_size = max_pattern_size
@@ -77,16 +106,294 @@ class SearchAgent:
         self.analyze = analyze
         self.model_type = model_type
         self.out_batch_size = out_batch_size
+        self.emb_cache = emb_cache
+        self.neigh_embs = None
+        self.neigh_index = None
+
+    def neigh_emb_matrix(self):
+        """All neighborhood embeddings stacked on the device, built on first
+        use."""
+        if self.neigh_embs is None:
+            self.neigh_embs = torch.cat([emb_batch.to(utils.get_device())
+                for emb_batch in self.embs], dim=0)
+        return self.neigh_embs
+
+    def neigh_dominance_index(self):
+        """DominanceIndex over the neighborhood embeddings, built on first
+        use."""
+        if self.neigh_index is None:
+            self.neigh_index = dominance_index.DominanceIndex(
+                self.neigh_emb_matrix(), chunk_size=SCORE_CHUNK_SIZE)
+        return self.neigh_index
+
+    def reduce_over_neighs(self, cand_embs, score_fn, pair_size=1):
+        """Sums score_fn(neigh_embs, cand_embs), a (candidates x
+        neighborhoods) matrix, over all neighborhood embeddings. The matrix is
+        computed in blocks of candidates and neighborhoods and reduced on the
+        device; the result is returned as one numpy array.
+
+        pair_size: number of floats score_fn holds per pair, which bounds
+            the blocks to SCORE_CHUNK_FLOATS floats.
+        """
+        neigh_embs = self.neigh_emb_matrix()
+        n_pairs = max(1, SCORE_CHUNK_FLOATS // pair_size)
+        cand_chunk = max(1, min(len(cand_embs), n_pairs))
+        neigh_chunk = max(1, n_pairs // cand_chunk)
+        with torch.no_grad():
+            total = torch.zeros(len(cand_embs), device=cand_embs.device)
+            for j in range(0, len(cand_embs), cand_chunk):
+                for i in range(0, len(neigh_embs), neigh_chunk):
+                    total[j:j+cand_chunk] += torch.sum(score_fn(
+                        neigh_embs[i:i+neigh_chunk],
+                        cand_embs[j:j+cand_chunk]), dim=1)
+        return total.cpu().numpy()
+
+    def score_candidates(self, cand_embs):
+        """Greedy search scores of candidate pattern embeddings (lower is
+        better): for "order" models, minus the number of neighborhoods
+        predicted to contain the candidate; for "mlp" models, the summed
+        log-probability of the neighborhoods not containing it.
+        """
+        if self.model_type == "order":
+            return -self.count_containing(cand_embs)
+        elif self.model_type == "mlp":
+            def score_fn(neigh_embs, cand_embs):
+                shape = (len(cand_embs), len(neigh_embs), cand_embs.shape[-1])
+                return self.model(neigh_embs.unsqueeze(0).expand(*shape),
+                    cand_embs.unsqueeze(1).expand(*shape))[:,:,0]
+            # per pair, the MLP holds its concatenated input and the output
+            # of each of its layers
+            pair_size = 2 * cand_embs.shape[-1] + sum(layer.out_features for
+                layer in self.model.mlp if isinstance(layer, nn.Linear)) * 2
+        else:
+            print("unrecognized model type")
+            return np.zeros(len(cand_embs))
+        return self.reduce_over_neighs(cand_embs, score_fn,
+            pair_size=pair_size)
+
+    def count_containing(self, cand_embs):
+        """Number of neighborhoods that an order model predicts to contain
+        each candidate pattern embedding, as a numpy array."""
+        # clf_model predicts containment iff w * violation + b > 0, with w
+        # and b the differences of its two logits' weights and biases
+        linear = self.model.clf_model[0]
+        w = (linear.weight[1] - linear.weight[0]).item()
+        b = (linear.bias[1] - linear.bias[0]).item()
+        index = self.neigh_dominance_index()
+        with torch.no_grad():
+            if w < 0:
+                counts = index.count_below(cand_embs, -b / w)
+            elif w > 0:
+                counts = len(index) - index.count_below(cand_embs, -b / w,
+                    strict=False)
+            else:
+                counts = torch.full((len(cand_embs),), len(index) if b > 0
+                    else 0, device=cand_embs.device)
+        return counts.cpu().numpy()
+
+    def embed_patterns(self, patterns):
+        """Embeddings (on the device) of the patterns induced by the
+        (graph_idx, neigh) pairs in patterns, anchored at neigh[0], looked up
+        in emb_cache if there is one."""
+        if self.emb_cache is None:
+            return self.run_emb_model(patterns)
+        return self.emb_cache.embed([self.pattern_key(graph_idx, neigh) for
+            graph_idx, neigh in patterns], lambda idx: self.run_emb_model(
+            [patterns[i] for i in idx]))
+
+    def run_emb_model(self, patterns):
+        """See embed_patterns. Patterns are embedded CAND_BATCH_SIZE at a
+        time.
 
-    def run_search(self, n_trials=1000): 
+        If the embedding model supports it, each pattern is embedded as an
+        extension of neigh[:-1] by neigh[-1]: the node states of neigh[:-1]
+        are computed once per batch and only the nodes near neigh[-1] are
+        recomputed."""
+        emb_model = self.model.emb_model
+        embs = []
+        with torch.no_grad():
+            for i in range(0, len(patterns), CAND_BATCH_SIZE):
+                chunk = patterns[i:i+CAND_BATCH_SIZE]
+                if (not emb_model.supports_extensions() or
+                    any(len(neigh) < 2 for _, neigh in chunk)):
+                    neighs = [self.dataset.neighborhood(graph_idx, neigh,
+                        center_loop=False) for graph_idx, neigh in chunk]
+                    embs.append(emb_model(utils.batch_edge_indices(neighs,
+                        anchors=[0]*len(neighs) if self.node_anchored else
+                        None)))
+                    continue
+                parent_idx, parents, attachments = {}, [], []
+                for graph_idx, neigh in chunk:
+                    key = (graph_idx, tuple(neigh[:-1]))
+                    if key not in parent_idx:
+                        parent_idx[key] = len(parent_idx)
+                    parents.append(parent_idx[key])
+                    attachments.append(np.nonzero(np.isin(neigh[:-1],
+                        self.dataset.neighbors(graph_idx, neigh[-1])))[0])
+                neighs = [self.dataset.neighborhood(graph_idx, list(neigh),
+                    center_loop=False) for graph_idx, neigh in parent_idx]
+                batch = utils.batch_edge_indices(neighs, anchors=[0]*len(
+                    neighs) if self.node_anchored else None)
+                # attachment positions are relative to each parent's nodes
+                starts = np.cumsum([0] + [n for n, _ in neighs])
+                attachments = [starts[p] + a for p, a in zip(parents,
+                    attachments)]
+                embs.append(emb_model.embed_extensions(emb_model.node_states(
+                    batch), batch.batch, batch.edge_index, parents,
+                    attachments, self.node_anchored))
+        return torch.cat(embs, dim=0)
+
+    def candidate_classes(self, patterns):
+        """Groups candidate patterns (graph_idx, neigh), each extending
+        neigh[:-1] by neigh[-1], into isomorphism classes of the patterns
+        they induce (anchored at neigh[0] if node_anchored), so that each
+        class is embedded and scored once. Candidates extending the same
+        pattern with the same attachments to it induce equal graphs and are
+        grouped without computing a canonical key.
+
+        Returns: one pattern per class, and the class index of each pattern.
+        """
+        classes, reps, inverse, by_attach = {}, [], [], {}
+        for graph_idx, neigh in patterns:
+            attach = np.nonzero(np.isin(neigh, self.dataset.neighbors(
+                graph_idx, neigh[-1])))[0]
+            attach_key = (graph_idx, tuple(neigh[:-1]), tuple(attach.tolist()))
+            if attach_key not in by_attach:
+                key = self.pattern_key(graph_idx, neigh)
+                if key not in classes:
+                    classes[key] = len(reps)
+                    reps.append((graph_idx, neigh))
+                by_attach[attach_key] = classes[key]
+            inverse.append(by_attach[attach_key])
+        return reps, np.array(inverse, dtype=np.int64)
+
+    def pattern_key(self, graph_idx, neigh):
+        """Canonical key of the pattern induced by neigh in graph graph_idx
+        (anchored at neigh[0] if node_anchored)."""
+        src, dst = self.dataset.subgraph_edges(graph_idx, neigh)
+        mask = src <= dst
+        return canonical.canonical_key_edges(len(neigh), tuple(sorted(zip(
+            src[mask].tolist(), dst[mask].tolist()))), frozenset([0]) if
+            self.node_anchored else frozenset())
+
+    def pattern_graph(self, graph_idx, neigh):
+        """networkx graph of the pattern induced by neigh in graph graph_idx,
+        without self loops. Node i is neigh[i]; node 0 carries the anchor."""
+        neigh_g = self.dataset.to_networkx(graph_idx, neigh)
+        neigh_g.remove_edges_from(nx.selfloop_edges(neigh_g))
+        for v in neigh_g.nodes:
+            neigh_g.nodes[v]["anchor"] = 1 if v == 0 else 0
+        return neigh_g
+
+    def run_search(self, n_trials=1000, checkpoint_path=None, resume=False,
+        stream_path=None):
+        """ Runs the search and returns the output patterns.
+
+        Args:
+            checkpoint_path: if given, the search state (including the random
+                states) is saved there after each step.
+            resume: continue from the checkpoint at checkpoint_path, if any.
+            stream_path: if given, the output patterns of each pattern size
+                are appended to this file (one pickled list per size) as soon
+                as they are final.
+        """
+        self.start_search(n_trials, checkpoint_path, resume, stream_path)
+        while not self.is_search_done():
+            self.step()
+            if not self.is_search_done():
+                self.save_progress(self.finished_sizes())
+        self.finish_search()
+        self.save_progress(range(self.min_pattern_size,
+            self.max_pattern_size+1))
+        return self.out_patterns
+
+    def start_search(self, n_trials, checkpoint_path, resume, stream_path,
+        init=True):
+        """Resets the search state, then calls init_search (if init) and
+        loads the checkpoint (if resume)."""
         self.cand_patterns = defaultdict(list)
         self.counts = defaultdict(lambda: defaultdict(list))
         self.n_trials = n_trials
+        self.out_patterns = []
+        self.out_sizes = set()
+        self.checkpoint_path = checkpoint_path
+        self.stream_path = stream_path
+        # last completed size checkpointed, see save_progress
+        self.checkpoint_size = None
+        if init:
+            self.init_search()
+        if resume and checkpoint_path and os.path.exists(checkpoint_path):
+            self.load_checkpoint(checkpoint_path)
+            print("resuming search from", checkpoint_path)
+        if stream_path is not None:
+            with open(stream_path, "wb") as f:
+                for size in sorted(self.out_sizes):
+                    pickle.dump([p for p in self.out_patterns if len(p) ==
+                        size], f)
 
-        self.init_search()
-        while not self.is_search_done():
-            self.step()
-        return self.finish_search()
+    def finished_sizes(self):
+        """Pattern sizes whose output can no longer change, while the search
+        is running."""
+        return []
+
+    def completed_size(self):
+        """Largest pattern size the search steps have completed, while the
+        search is running (None if unknown)."""
+        return None
+
+    def save_progress(self, sizes):
+        """Adds the output patterns of sizes not output yet, saves a
+        checkpoint and then appends the new patterns to the stream. Does
+        nothing unless there are such sizes or the search has completed a
+        pattern size (of at least min_pattern_size) since the last call, as
+        each checkpoint pickles the whole search state."""
+        new_sizes = [size for size in sorted(sizes) if size not in
+            self.out_sizes]
+        size = self.completed_size()
+        size_done = (size is not None and size >= self.min_pattern_size and
+            size != self.checkpoint_size)
+        if not new_sizes and not size_done:
+            return
+        self.checkpoint_size = size
+        new_patterns = [self.size_patterns(size) for size in new_sizes]
+        for size, patterns in zip(new_sizes, new_patterns):
+            self.out_patterns += patterns
+            self.out_sizes.add(size)
+        if self.checkpoint_path is not None:
+            self.save_checkpoint(self.checkpoint_path)
+        if self.stream_path is not None:
+            with open(self.stream_path, "ab") as f:
+                for patterns in new_patterns:
+                    pickle.dump(patterns, f)
+
+    # search state saved in checkpoints, extended by the subclasses
+    checkpoint_attrs = ["n_trials", "cand_patterns", "counts", "out_patterns",
+        "out_sizes"]
+
+    def save_checkpoint(self, path):
+        state = {attr: plain_dicts(getattr(self, attr)) for attr in
+            self.checkpoint_attrs}
+        state["rng"] = (random.getstate(), np.random.get_state(),
+            torch.get_rng_state())
+        # write and rename, so a crash never leaves a partial checkpoint
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def load_checkpoint(self, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        rng = state.pop("rng")
+        for attr, value in state.items():
+            if isinstance(getattr(self, attr, None), defaultdict):
+                current = getattr(self, attr)
+                current.clear()
+                merge_dicts(current, value)
+            else:
+                setattr(self, attr, value)
+        random.setstate(rng[0])
+        np.random.set_state(rng[1])
+        torch.set_rng_state(rng[2])
 
     def init_search():
         raise NotImplementedError
@@ -99,165 +406,306 @@ class SearchAgent:
         """
         raise NotImplementedError
 
+class SeedIndex:
+    """Visited MCTS seeds indexed for max-UCT queries.
+
+    The UCT score of a seed with n visits and mean value q is
+    q + c_uct * sqrt(log_n / n), where log_n is shared by all seeds. Seeds are
+    therefore bucketed by visit count, with a max-heap on q per bucket, and
+    the best seed is found by comparing the top of each bucket. Heap entries
+    are invalidated lazily when a seed is updated or removed.
+    """
+    def __init__(self):
+        self.buckets = defaultdict(list)
+        self.entries = {}
+
+    def update(self, seed, visits, value):
+        q = value / (visits or 1)
+        self.entries[seed] = visits, q
+        heapq.heappush(self.buckets[visits], (-q, seed))
+
+    def remove(self, seed):
+        self.entries.pop(seed, None)
+
+    def best(self, c_uct, log_n):
+        """(seed, score) of the seed with the highest UCT score, or
+        (None, -inf) if the index is empty."""
+        best_seed, best_score = None, -float("inf")
+        for visits in sorted(self.buckets):
+            heap = self.buckets[visits]
+            while heap and self.entries.get(heap[0][1]) != (visits,
+                -heap[0][0]):
+                heapq.heappop(heap)
+            if not heap:
+                del self.buckets[visits]
+                continue
+            score = -heap[0][0] + c_uct * np.sqrt(log_n / (visits or 1))
+            if score > best_score:
+                best_seed, best_score = heap[0][1], score
+        return best_seed, best_score
+
 class MCTSSearchAgent(SearchAgent):
     def __init__(self, min_pattern_size, max_pattern_size, model, dataset,
         embs, node_anchored=False, analyze=False, model_type="order",
-        out_batch_size=20, c_uct=0.7):
+        out_batch_size=20, c_uct=0.7, sim_batch_size=16, n_threads=1,
+        virtual_loss=1.0, emb_cache=None):
         """ MCTS implementation of the subgraph pattern search.
         Uses MCTS strategy to search for the most common pattern.
 
         Args:
             c_uct: the exploration constant used in UCT criteria (See paper).
+            sim_batch_size: number of simulations expanded together (see
+                step). 1 runs the simulations strictly one after another.
+            n_threads: number of threads running groups of simulations
+                concurrently. They share the search statistics, and overlap
+                one group's model calls with another's bookkeeping.
+            virtual_loss: value subtracted from an edge of the search tree
+                (on top of counting a visit) while a simulation that took it
+                is in flight, so that concurrent simulations spread out.
         """
         super().__init__(min_pattern_size, max_pattern_size, model, dataset,
             embs, node_anchored=node_anchored, analyze=analyze,
-            model_type=model_type, out_batch_size=out_batch_size)
+            model_type=model_type, out_batch_size=out_batch_size,
+            emb_cache=emb_cache)
         self.c_uct = c_uct
+        self.sim_batch_size = sim_batch_size
+        self.n_threads = n_threads
+        self.virtual_loss = virtual_loss
+        # guards the search statistics shared by the threads
+        self.lock = threading.Lock()
         assert not analyze
 
     def init_search(self):
         self.wl_hash_to_graphs = defaultdict(list)
         self.cum_action_values = defaultdict(lambda: defaultdict(float))
         self.visit_counts = defaultdict(lambda: defaultdict(float))
+        # running totals of the above over the actions of each state
+        self.state_values = defaultdict(float)
+        self.state_visits = defaultdict(float)
         self.visited_seed_nodes = set()
+        self.seed_index = SeedIndex()
         self.max_size = self.min_pattern_size
 
     def is_search_done(self):
         return self.max_size == self.max_pattern_size + 1
 
-    # returns whether there are at least n nodes reachable from start_node in graph
-    def has_min_reachable_nodes(self, graph, start_node, n):
-        for depth_limit in range(n+1):
-            edges = nx.bfs_edges(graph, start_node, depth_limit=depth_limit)
-            nodes = set([v for u, v in edges])
-            if len(nodes) + 1 >= n:
-                return True
-        return False
+    def completed_size(self):
+        # each step runs the simulations of one size
+        return self.max_size - 1
 
-    def step(self):
-        ps = np.array([len(g) for g in self.dataset], dtype=np.float)
-        ps /= np.sum(ps)
-        graph_dist = stats.rv_discrete(values=(np.arange(len(self.dataset)), ps))
+    def select_seed(self, simulation_n):
+        """Seed (graph_idx, start_node) for a simulation: the visited seed with
+        the best UCT score, or a new random seed if none beats choosing a new
+        one. The seed is taken out of the seed index until its simulation
+        backs up, so simulations in flight get distinct seeds."""
+        log_n = np.log(simulation_n or 1)
+        best_seed, best_score = self.seed_index.best(self.c_uct, log_n)
+        # if existing seed beats choosing a new seed
+        if best_score >= self.c_uct * np.sqrt(log_n):
+            graph_idx, start_node = best_seed
+            assert start_node < self.dataset.num_nodes(graph_idx)
+        else:
+            # don't pick isolated nodes or small islands
+            graph_idx, start_node = self.dataset.sampler.sample_start(
+                self.min_pattern_size)
+            self.visited_seed_nodes.add((graph_idx, start_node))
+        self.seed_index.remove((graph_idx, start_node))
+        return graph_idx, start_node
+
+    def add_visit(self, state, next_state, value):
+        self.visit_counts[state][next_state] += 1
+        self.state_visits[state] += 1
+        self.add_value(state, next_state, value)
 
+    def add_value(self, state, next_state, value):
+        self.cum_action_values[state][next_state] += value
+        self.state_values[state] += value
+
+    def step(self):
+        """ Runs the simulations for the current pattern size in groups of
+        sim_batch_size, spread over n_threads threads (see run_group).
+        """
         print("Size", self.max_size)
         print(len(self.visited_seed_nodes), "distinct seeds")
-        for simulation_n in tqdm(range(self.n_trials //
-            (self.max_pattern_size+1-self.min_pattern_size))):
-            # pick seed node
-            best_graph_idx, best_start_node, best_score = None, None, -float("inf")
-            for cand_graph_idx, cand_start_node in self.visited_seed_nodes:
-                state = cand_graph_idx, cand_start_node
-                my_visit_counts = sum(self.visit_counts[state].values())
-                q_score = (sum(self.cum_action_values[state].values()) /
-                    (my_visit_counts or 1))
-                uct_score = self.c_uct * np.sqrt(np.log(simulation_n or 1) /
-                    (my_visit_counts or 1))
-                node_score = q_score + uct_score
-                if node_score > best_score:
-                    best_score = node_score
-                    best_graph_idx = cand_graph_idx
-                    best_start_node = cand_start_node
-            # if existing seed beats choosing a new seed
-            if best_score >= self.c_uct * np.sqrt(np.log(simulation_n or 1)):
-                graph_idx, start_node = best_graph_idx, best_start_node
-                assert best_start_node in self.dataset[graph_idx].nodes
-                graph = self.dataset[graph_idx]
-            else:
-                found = False
-                while not found:
-                    graph_idx = np.arange(len(self.dataset))[graph_dist.rvs()]
-                    graph = self.dataset[graph_idx]
-                    start_node = random.choice(list(graph.nodes))
-                    # don't pick isolated nodes or small islands
-                    if self.has_min_reachable_nodes(graph, start_node,
-                        self.min_pattern_size):
-                        found = True
-                self.visited_seed_nodes.add((graph_idx, start_node))
-            neigh = [start_node]
-            frontier = list(set(graph.neighbors(start_node)) - set(neigh))
-            visited = set([start_node])
-            neigh_g = nx.Graph()
-            neigh_g.add_node(start_node, anchor=1)
-            cur_state = graph_idx, start_node
-            state_list = [cur_state]
-            while frontier and len(neigh) < self.max_size:
-                cand_neighs, anchors = [], []
-                for cand_node in frontier:
-                    cand_neigh = graph.subgraph(neigh + [cand_node])
-                    cand_neighs.append(cand_neigh)
-                    if self.node_anchored:
-                        anchors.append(neigh[0])
-                cand_embs = self.model.emb_model(utils.batch_nx_graphs(
-                    cand_neighs, anchors=anchors if self.node_anchored else None))
-                best_v_score, best_node_score, best_node = 0, -float("inf"), None
-                for cand_node, cand_emb in zip(frontier, cand_embs):
-                    score, n_embs = 0, 0
-                    for emb_batch in self.embs:
-                        score += torch.sum(self.model.predict((
-                            emb_batch.to(utils.get_device()), cand_emb))).item()
-                        n_embs += len(emb_batch)
-                    v_score = -np.log(score/n_embs + 1) + 1
-                    # get wl hash of next state
-                    neigh_g = graph.subgraph(neigh + [cand_node]).copy()
-                    neigh_g.remove_edges_from(nx.selfloop_edges(neigh_g))
-                    for v in neigh_g.nodes:
-                        neigh_g.nodes[v]["anchor"] = 1 if v == neigh[0] else 0
-                    next_state = utils.wl_hash(neigh_g,
-                        node_anchored=self.node_anchored)
-                    # compute node score
-                    parent_visit_counts = sum(self.visit_counts[cur_state].values())
-                    my_visit_counts = sum(self.visit_counts[next_state].values())
-                    q_score = (sum(self.cum_action_values[next_state].values()) /
-                        (my_visit_counts or 1))
-                    uct_score = self.c_uct * np.sqrt(np.log(parent_visit_counts or
-                        1) / (my_visit_counts or 1))
-                    node_score = q_score + uct_score
-                    if node_score > best_node_score:
-                        best_node_score = node_score
-                        best_v_score = v_score
-                        best_node = cand_node
-                frontier = list(((set(frontier) |
-                    set(graph.neighbors(best_node))) - visited) -
-                    set([best_node]))
-                visited.add(best_node)
-                neigh.append(best_node)
-
-                # update visit counts, wl cache
-                neigh_g = graph.subgraph(neigh).copy()
-                neigh_g.remove_edges_from(nx.selfloop_edges(neigh_g))
-                for v in neigh_g.nodes:
-                    neigh_g.nodes[v]["anchor"] = 1 if v == neigh[0] else 0
-                prev_state = cur_state
-                cur_state = utils.wl_hash(neigh_g, node_anchored=self.node_anchored)
-                state_list.append(cur_state)
-                self.wl_hash_to_graphs[cur_state].append(neigh_g)
-
-            # backprop value
-            for i in range(0, len(state_list) - 1):
-                self.cum_action_values[state_list[i]][
-                    state_list[i+1]] += best_v_score
-                self.visit_counts[state_list[i]][state_list[i+1]] += 1
+        n_sims = self.n_trials // (self.max_pattern_size+1-self.min_pattern_size)
+        groups = [(start, min(n_sims, start + self.sim_batch_size)) for start
+            in range(0, n_sims, self.sim_batch_size)]
+        if self.n_threads <= 1:
+            for group in tqdm(groups):
+                self.run_group(*group)
+        else:
+            # built here rather than lazily by the threads, which would race
+            # to build them
+            self.neigh_dominance_index()
+            pending = list(reversed(groups))
+            errors = []
+            pbar = tqdm(total=len(groups))
+            def worker():
+                try:
+                    while True:
+                        with self.lock:
+                            if not pending or errors: return
+                            group = pending.pop()
+                        self.run_group(*group)
+                        pbar.update(1)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=worker) for _ in
+                range(self.n_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            pbar.close()
+            if errors:
+                raise errors[0]
         self.max_size += 1
 
+    def run_group(self, start, end):
+        """ Runs simulations start .. end-1. The simulations are seeded from
+        distinct seeds and expanded in lockstep, so that each expansion embeds
+        and scores the candidates of the whole group at once. Each edge taken
+        carries a virtual loss until the group backs up its values.
+        """
+        sims = []
+        with self.lock:
+            for simulation_n in range(start, end):
+                graph_idx, start_node = self.select_seed(simulation_n)
+                sims.append({"graph_idx": graph_idx, "neigh": [start_node],
+                    "frontier": list(set(self.dataset.neighbors(graph_idx,
+                        start_node).tolist()) - set([start_node])),
+                    "visited": set([start_node]),
+                    "state_list": [(graph_idx, start_node)],
+                    "v_score": 0})
+        active = [sim for sim in sims if sim["frontier"] and
+            len(sim["neigh"]) < self.max_size]
+        while active:
+            patterns = [(sim["graph_idx"], sim["neigh"] + [cand_node])
+                for sim in active for cand_node in sim["frontier"]]
+            reps, inverse = self.candidate_classes(patterns)
+            with torch.no_grad():
+                scores = self.neigh_dominance_index().sum_violations(
+                    self.embed_patterns(reps)).cpu().numpy()[inverse]
+            n_embs = len(self.neigh_emb_matrix())
+            pos = 0
+            with self.lock:
+                for sim in active:
+                    n_cands = len(sim["frontier"])
+                    self.expand(sim, scores[pos:pos+n_cands], n_embs)
+                    pos += n_cands
+            active = [sim for sim in active if sim["frontier"] and
+                len(sim["neigh"]) < self.max_size]
+
+        # backprop value, replacing the virtual losses
+        with self.lock:
+            for sim in sims:
+                state_list = sim["state_list"]
+                for i in range(0, len(state_list) - 1):
+                    self.add_value(state_list[i], state_list[i+1],
+                        sim["v_score"] + self.virtual_loss)
+                seed = state_list[0]
+                self.seed_index.update(seed, self.state_visits[seed],
+                    self.state_values[seed])
+
+    def expand(self, sim, scores, n_embs):
+        """ Adds to simulation sim the frontier node with the best UCT score,
+        given the summed violations scores of its frontier nodes.
+        """
+        graph_idx, neigh = sim["graph_idx"], sim["neigh"]
+        cur_state = sim["state_list"][-1]
+        best_v_score, best_node_score, best_node = 0, -float("inf"), None
+        for cand_node, score in zip(sim["frontier"], scores.tolist()):
+            v_score = -np.log(score/n_embs + 1) + 1
+            # get wl hash of next state
+            neigh_g = self.pattern_graph(graph_idx, neigh + [cand_node])
+            next_state = utils.wl_hash(neigh_g,
+                node_anchored=self.node_anchored)
+            # compute node score
+            parent_visit_counts = self.state_visits[cur_state]
+            my_visit_counts = self.state_visits[next_state]
+            q_score = (self.state_values[next_state] /
+                (my_visit_counts or 1))
+            uct_score = self.c_uct * np.sqrt(np.log(parent_visit_counts or
+                1) / (my_visit_counts or 1))
+            node_score = q_score + uct_score
+            if node_score > best_node_score:
+                best_node_score = node_score
+                best_v_score = v_score
+                best_node = cand_node
+        sim["frontier"] = list(((set(sim["frontier"]) |
+            set(self.dataset.neighbors(graph_idx,
+            best_node).tolist())) - sim["visited"]) - set([best_node]))
+        sim["visited"].add(best_node)
+        neigh.append(best_node)
+        sim["v_score"] = best_v_score
+
+        # update wl cache, count the visit with a virtual loss
+        neigh_g = self.pattern_graph(graph_idx, neigh)
+        next_state = utils.wl_hash(neigh_g, node_anchored=self.node_anchored)
+        sim["state_list"].append(next_state)
+        self.wl_hash_to_graphs[next_state].append(neigh_g)
+        self.add_visit(cur_state, next_state, -self.virtual_loss)
+
+    checkpoint_attrs = SearchAgent.checkpoint_attrs + ["wl_hash_to_graphs",
+        "cum_action_values", "visit_counts", "state_values", "state_visits",
+        "visited_seed_nodes", "seed_index", "max_size"]
+
     def finish_search(self):
         counts = defaultdict(lambda: defaultdict(int))
         for _, v in self.visit_counts.items():
             for s2, count in v.items():
                 counts[len(random.choice(self.wl_hash_to_graphs[s2]))][s2] += count
+        self.state_counts = counts
 
+    def size_patterns(self, pattern_size):
         cand_patterns_uniq = []
-        for pattern_size in range(self.min_pattern_size, self.max_pattern_size+1):
-            for wl_hash, count in sorted(counts[pattern_size].items(), key=lambda
-                x: x[1], reverse=True)[:self.out_batch_size]:
-                cand_patterns_uniq.append(random.choice(
-                    self.wl_hash_to_graphs[wl_hash]))
-                print("- outputting", count, "motifs of size", pattern_size)
+        for wl_hash, count in sorted(self.state_counts[pattern_size].items(),
+            key=lambda x: x[1], reverse=True)[:self.out_batch_size]:
+            # a wl hash can cover non-isomorphic graphs; output one of the
+            # most common isomorphism class
+            cand_patterns_uniq.append(random.choice(max(
+                canonical.group_isomorphic(self.wl_hash_to_graphs[wl_hash],
+                node_anchored=self.node_anchored), key=len)))
+            print("- outputting", count, "motifs of size", pattern_size)
         return cand_patterns_uniq
 
+# agent of a parallel greedy search worker, see GreedySearchAgent.run_search
+search_agent = None
+
+def init_search_worker(kwargs, dataset, neigh_embs, neigh_index):
+    """Builds the worker's agent from GreedySearchAgent.worker_args (or drops
+    it if kwargs is None). dataset is a GraphStore or the path of one, which
+    is then memory-mapped."""
+    global search_agent
+    if kwargs is None:
+        search_agent = None
+        return
+    if isinstance(dataset, str):
+        dataset = GraphStore.load(dataset, mmap_mode="r")
+    search_agent = GreedySearchAgent(dataset=dataset, **kwargs)
+    search_agent.neigh_embs = neigh_embs
+    search_agent.neigh_index = neigh_index
+
+def run_search_shard(inp):
+    return search_agent.run_shard(*inp)
+
+def run_search_shard_inline(inp):
+    """run_search_shard in the searching process, whose random state is left
+    as it was, as with a worker process."""
+    rng = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    try:
+        return run_search_shard(inp)
+    finally:
+        random.setstate(rng[0])
+        np.random.set_state(rng[1])
+        torch.set_rng_state(rng[2])
+
 class GreedySearchAgent(SearchAgent):
     def __init__(self, min_pattern_size, max_pattern_size, model, dataset,
         embs, node_anchored=False, analyze=False, rank_method="counts",
-        model_type="order", out_batch_size=20, n_beams=1):
+        model_type="order", out_batch_size=20, n_beams=1, n_workers=0,
+        shard_size=50, seed=0, emb_cache=None, progressive=False,
+        error_prob=0.05, initial_sample_size=1024):
         """Greedy implementation of the subgraph pattern search.
         At every step, the algorithm chooses greedily the next node to grow while the pattern
         remains predicted to be frequent. The criteria to choose the next action depends
@@ -271,26 +719,147 @@ class GreedySearchAgent(SearchAgent):
                 if rank_method=='margin', margin score of the pattern predicted by the matching model is
                     used.
                 if rank_method=='hybrid', it considers both the count and margin to rank the actions.
+            n_workers: the trials are split into shards of shard_size
+                trials, searched by a pool of n_workers processes (one after
+                another in this process if 0). Each shard is seeded from
+                (seed, shard index) and the results are merged in shard
+                order, so they do not depend on n_workers. The workers share
+                emb_cache only if its store comes from a
+                models.EmbeddingStoreManager.
+            progressive: score candidates on growing random samples of the
+                neighborhoods (see score_candidates_progressive) instead of
+                on all of them. Order models only.
+            error_prob: with progressive, the probability that a step keeps
+                other beams than scoring on all neighborhoods would.
+            initial_sample_size: number of neighborhoods in the first sample.
         """
         super().__init__(min_pattern_size, max_pattern_size, model, dataset,
             embs, node_anchored=node_anchored, analyze=analyze,
-            model_type=model_type, out_batch_size=out_batch_size)
+            model_type=model_type, out_batch_size=out_batch_size,
+            emb_cache=emb_cache)
         self.rank_method = rank_method
         self.n_beams = n_beams
+        self.n_workers = n_workers
+        self.shard_size = shard_size
+        self.seed = seed
+        self.progressive = progressive
+        self.error_prob = error_prob
+        self.initial_sample_size = initial_sample_size
+        assert not progressive or model_type == "order"
         print("Rank Method:", rank_method)
 
-    def init_search(self):
-        ps = np.array([len(g) for g in self.dataset], dtype=np.float)
-        ps /= np.sum(ps)
-        graph_dist = stats.rv_discrete(values=(np.arange(len(self.dataset)), ps))
+    checkpoint_attrs = SearchAgent.checkpoint_attrs + ["beam_sets",
+        "analyze_embs"]
+
+    def run_search(self, n_trials=1000, checkpoint_path=None, resume=False,
+        stream_path=None):
+        """ See SearchAgent.run_search. The trials are searched in shards
+        (see __init__), so the checkpoint is saved after each shard and all
+        output patterns are final at the end only.
+        """
+        shards = [(shard_idx, min(self.shard_size, n_trials - start), self.seed)
+            for shard_idx, start in enumerate(range(0, n_trials,
+                self.shard_size))]
+        self.checkpoint_attrs = GreedySearchAgent.checkpoint_attrs + [
+            "n_shards_done"]
+        self.n_shards_done = 0
+        # the shards run their own beams
+        self.beam_sets = []
+        self.analyze_embs = []
+        self.start_search(n_trials, checkpoint_path, resume, stream_path,
+            init=False)
+        if self.n_workers > 0:
+            pool = mp.Pool(self.n_workers, initializer=init_search_worker,
+                initargs=self.worker_args())
+            results = pool.imap(run_search_shard, shards[self.n_shards_done:])
+        else:
+            pool = None
+            init_search_worker(*self.worker_args(shared=False))
+            results = map(run_search_shard_inline, shards[
+                self.n_shards_done:])
+        try:
+            for cand_patterns, counts, analyze_embs in results:
+                for size, patterns in cand_patterns.items():
+                    self.cand_patterns[size] += patterns
+                for size, size_counts in counts.items():
+                    for wl_hash, neighs in size_counts.items():
+                        self.counts[size][wl_hash] += neighs
+                for i, embs in enumerate(analyze_embs):
+                    if i == len(self.analyze_embs):
+                        self.analyze_embs.append([])
+                    self.analyze_embs[i] += embs
+                self.n_shards_done += 1
+                # no size is final before the last shard, so checkpoint
+                # shards instead
+                if self.checkpoint_path is not None:
+                    self.save_checkpoint(self.checkpoint_path)
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                # stops the workers if a shard raised
+                pool.terminate()
+            else:
+                init_search_worker(None, None, None, None)
+        self.finish_search()
+        self.save_progress(range(self.min_pattern_size,
+            self.max_pattern_size+1))
+        return self.out_patterns
+
+    def worker_args(self, shared=True):
+        """Arguments of init_search_worker for a search worker. If shared
+        (for a parallel search worker), the model, the neighborhood
+        embeddings and their index are moved to shared memory, and a store
+        loaded from disk is passed by path, so that workers do not get copies
+        of them even when spawned."""
+        neigh_embs = self.neigh_emb_matrix()
+        neigh_index = (self.neigh_dominance_index() if self.model_type ==
+            "order" else None)
+        dataset = self.dataset
+        if shared:
+            self.model.share_memory()
+            for emb_batch in self.embs:
+                emb_batch.share_memory_()
+            neigh_embs.share_memory_()
+            if neigh_index is not None:
+                neigh_index.share_memory()
+            if dataset.path is not None:
+                dataset = dataset.path
+        kwargs = dict(min_pattern_size=self.min_pattern_size,
+            max_pattern_size=self.max_pattern_size, model=self.model,
+            embs=self.embs, node_anchored=self.node_anchored,
+            analyze=self.analyze, rank_method=self.rank_method,
+            model_type=self.model_type, out_batch_size=self.out_batch_size,
+            n_beams=self.n_beams, emb_cache=self.emb_cache,
+            progressive=self.progressive, error_prob=self.error_prob,
+            initial_sample_size=self.initial_sample_size)
+        return kwargs, dataset, neigh_embs, neigh_index
+
+    def run_shard(self, shard_idx, n_trials, seed):
+        """Runs n_trials trials of the search with random state seeded from
+        (seed, shard_idx), in a parallel search worker.
+
+        Returns: cand_patterns, counts and analyze_embs of the shard.
+        """
+        random.seed("{}-{}".format(seed, shard_idx))
+        np.random.seed(random.randrange(2**32))
+        self.cand_patterns = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(list))
+        self.n_trials = n_trials
+        self.init_search()
+        while not self.is_search_done():
+            self.step()
+        return (dict(self.cand_patterns), {size: dict(size_counts) for size,
+            size_counts in self.counts.items()}, self.analyze_embs)
 
+    def init_search(self):
         beams = []
         for trial in range(self.n_trials):
-            graph_idx = np.arange(len(self.dataset))[graph_dist.rvs()]
-            graph = self.dataset[graph_idx]
-            start_node = random.choice(list(graph.nodes))
+            graph_idx, start_node = self.dataset.sampler.sample_start(1)
             neigh = [start_node]
-            frontier = list(set(graph.neighbors(start_node)) - set(neigh))
+            frontier = list(set(self.dataset.neighbors(graph_idx,
+                start_node).tolist()) - set(neigh))
             visited = set([start_node])
             beams.append([(0, neigh, frontier, visited, graph_idx)])
         self.beam_sets = beams
@@ -304,61 +873,53 @@ class GreedySearchAgent(SearchAgent):
         print("seeds come from", len(set(b[0][-1] for b in self.beam_sets)),
             "distinct graphs")
         analyze_embs_cur = []
-        for beam_set in tqdm(self.beam_sets):
-            new_beams = []
-            for _, neigh, frontier, visited, graph_idx in beam_set:
-                graph = self.dataset[graph_idx]
-                if len(neigh) >= self.max_pattern_size or not frontier: continue
-                cand_neighs, anchors = [], []
-                for cand_node in frontier:
-                    cand_neigh = graph.subgraph(neigh + [cand_node])
-                    cand_neighs.append(cand_neigh)
-                    if self.node_anchored:
-                        anchors.append(neigh[0])
-                cand_embs = self.model.emb_model(utils.batch_nx_graphs(
-                    cand_neighs, anchors=anchors if self.node_anchored else None))
-                best_score, best_node = float("inf"), None
-                for cand_node, cand_emb in zip(frontier, cand_embs):
-                    score, n_embs = 0, 0
-                    for emb_batch in self.embs:
-                        n_embs += len(emb_batch)
-                        if self.model_type == "order":
-                            score -= torch.sum(torch.argmax(
-                                self.model.clf_model(self.model.predict((
-                                emb_batch.to(utils.get_device()),
-                                cand_emb)).unsqueeze(1)), axis=1)).item()
-                        elif self.model_type == "mlp":
-                            score += torch.sum(self.model(
-                                emb_batch.to(utils.get_device()),
-                                cand_emb.unsqueeze(0).expand(len(emb_batch), -1)
-                                )[:,0]).item()
-                        else:
-                            print("unrecognized model type")
-                    if score < best_score:
-                        best_score = score
-                        best_node = cand_node
-                    new_frontier = list(((set(frontier) |
-                        set(graph.neighbors(cand_node))) - visited) -
-                        set([cand_node]))
-                    new_beams.append((
-                        score, neigh + [cand_node],
-                        new_frontier, visited | set([cand_node]), graph_idx))
+        # embed and score the candidates of all beam sets together
+        expansions = [(set_idx, beam) for set_idx, beam_set in
+            enumerate(self.beam_sets) for beam in beam_set
+            if len(beam[1]) < self.max_pattern_size and beam[2]]
+        patterns = [(graph_idx, neigh + [cand_node]) for _, (_, neigh, frontier,
+            _, graph_idx) in expansions for cand_node in frontier]
+        if patterns:
+            reps, inverse = self.candidate_classes(patterns)
+            cand_embs = self.embed_patterns(reps)
+            if self.progressive:
+                # the candidate classes of each beam set
+                set_idxs = np.repeat([set_idx for set_idx, _ in expansions],
+                    [len(beam[2]) for _, beam in expansions])
+                groups = [np.unique(inverse[set_idxs == set_idx]) for set_idx
+                    in np.unique(set_idxs)]
+                scores = self.score_candidates_progressive(cand_embs,
+                    groups)[inverse]
+            else:
+                scores = self.score_candidates(cand_embs)[inverse]
+        else:
+            scores = []
+        cand_beam_sets = [[] for _ in self.beam_sets]
+        pos = 0
+        for set_idx, (_, neigh, frontier, visited, graph_idx) in expansions:
+            for cand_node, score in zip(frontier,
+                scores[pos:pos+len(frontier)].tolist()):
+                new_frontier = list(((set(frontier) |
+                    set(self.dataset.neighbors(graph_idx,
+                    cand_node).tolist())) - visited) - set([cand_node]))
+                cand_beam_sets[set_idx].append((
+                    score, neigh + [cand_node],
+                    new_frontier, visited | set([cand_node]), graph_idx))
+            pos += len(frontier)
+
+        for new_beams in tqdm(cand_beam_sets):
             new_beams = list(sorted(new_beams, key=lambda x:
                 x[0]))[:self.n_beams]
             for score, neigh, frontier, visited, graph_idx in new_beams[:1]:
-                graph = self.dataset[graph_idx]
                 # add to record
-                neigh_g = graph.subgraph(neigh).copy()
-                neigh_g.remove_edges_from(nx.selfloop_edges(neigh_g))
-                for v in neigh_g.nodes:
-                    neigh_g.nodes[v]["anchor"] = 1 if v == neigh[0] else 0
+                neigh_g = self.pattern_graph(graph_idx, neigh)
                 self.cand_patterns[len(neigh_g)].append((score, neigh_g))
                 if self.rank_method in ["counts", "hybrid"]:
                     self.counts[len(neigh_g)][utils.wl_hash(neigh_g,
                         node_anchored=self.node_anchored)].append(neigh_g)
                 if self.analyze and len(neigh) >= 3:
                     emb = self.model.emb_model(utils.batch_nx_graphs(
-                        [neigh_g], anchors=[neigh[0]] if self.node_anchored
+                        [neigh_g], anchors=[0] if self.node_anchored
                         else None)).squeeze(0)
                     analyze_embs_cur.append(emb.detach().cpu().numpy())
             if len(new_beams) > 0:
@@ -366,6 +927,68 @@ class GreedySearchAgent(SearchAgent):
         self.beam_sets = new_beam_sets
         self.analyze_embs.append(analyze_embs_cur)
 
+    def score_candidates_progressive(self, cand_embs, groups):
+        """Estimates of score_candidates, accurate enough to rank each group
+        of candidates (the candidates of a beam set, as arrays of indices
+        into cand_embs) like score_candidates would.
+
+        The candidates are scored on a random sample of initial_sample_size
+        neighborhoods, doubled in every round. After each round, a
+        candidate's fraction of containing neighborhoods lies within a
+        Hoeffding radius of its sample mean, except with probability
+        error_prob over all candidates and rounds. A candidate whose upper
+        bound is below the n_beams-th largest lower bound of its group
+        cannot be kept. Candidates are scored until their groups are down to
+        n_beams candidates; if sampling gets to all neighborhoods, the
+        candidates left are counted exactly with count_containing. The
+        number of neighborhoods sampled thus depends on how close the best
+        candidates are, not on the number of neighborhoods.
+
+        Returns: minus the estimated number of neighborhoods containing each
+        candidate (exact for candidates scored on all of them).
+        """
+        neigh_embs = self.neigh_emb_matrix()
+        n_embs = len(neigh_embs)
+        perm = torch.from_numpy(np.random.permutation(n_embs)).to(
+            neigh_embs.device)
+        n_rounds = 1 + max(0, int(np.ceil(np.log2(n_embs /
+            self.initial_sample_size))))
+        hits = np.zeros(len(cand_embs))
+        seen = np.zeros(len(cand_embs))
+        survivors = list(groups)
+        alive = np.arange(len(cand_embs))
+        start, end = 0, min(self.initial_sample_size, n_embs)
+        with torch.no_grad():
+            while True:
+                embs = cand_embs[torch.from_numpy(alive).to(cand_embs.device)]
+                if end == n_embs:
+                    hits[alive] = self.count_containing(embs)
+                    seen[alive] = n_embs
+                    break
+                sample = neigh_embs[perm[start:end]]
+                chunk_size = max(1, SCORE_CHUNK_SIZE // len(alive))
+                for i in range(0, len(sample), chunk_size):
+                    violation = self.model.predict((sample[i:i+chunk_size]
+                        .unsqueeze(0), embs.unsqueeze(1)))
+                    hits[alive] += torch.sum(torch.argmax(self.model.clf_model(
+                        violation.unsqueeze(-1)), dim=-1), dim=1).cpu().numpy()
+                seen[alive] = end
+                radius = np.sqrt(np.log(2 * len(cand_embs) * n_rounds /
+                    self.error_prob) / (2 * end))
+                est = hits / seen
+                for i, group in enumerate(survivors):
+                    if len(group) > self.n_beams:
+                        kth_lower = np.sort(est[group])[-self.n_beams] - radius
+                        survivors[i] = group[est[group] + radius >= kth_lower]
+                # groups down to n_beams candidates are decided
+                open_groups = [group for group in survivors if len(group) >
+                    self.n_beams]
+                if not open_groups:
+                    break
+                alive = np.unique(np.concatenate(open_groups))
+                start, end = end, min(2 * end, n_embs)
+        return -hits * (n_embs / seen)
+
     def finish_search(self):
         if self.analyze:
             print("Saving analysis info in results/analyze.p")
@@ -382,30 +1005,27 @@ class GreedySearchAgent(SearchAgent):
             plt.savefig("plots/analyze.png")
             plt.close()
 
+    def size_patterns(self, pattern_size):
         cand_patterns_uniq = []
-        for pattern_size in range(self.min_pattern_size, self.max_pattern_size+1):
-            if self.rank_method == "hybrid":
-                cur_rank_method = "margin" if len(max(
-                    self.counts[pattern_size].values(), key=len)) < 3 else "counts"
-            else:
-                cur_rank_method = self.rank_method
-
-            if cur_rank_method == "margin":
-                wl_hashes = set()
-                cands = cand_patterns[pattern_size]
-                cand_patterns_uniq_size = []
-                for pattern in sorted(cands, key=lambda x: x[0]):
-                    wl_hash = utils.wl_hash(pattern[1], node_anchored=node_anchored)
-                    if wl_hash not in wl_hashes:
-                        wl_hashes.add(wl_hash)
-                        cand_patterns_uniq_size.append(pattern[1])
-                        if len(cand_patterns_uniq_size) >= out_batch_size:
-                            cand_patterns_uniq += cand_patterns_uniq_size
-                            break
-            elif cur_rank_method == "counts":
-                for _, neighs in list(sorted(self.counts[pattern_size].items(),
-                    key=lambda x: len(x[1]), reverse=True))[:self.out_batch_size]:
-                    cand_patterns_uniq.append(random.choice(neighs))
-            else:
-                print("Unrecognized rank method")
+        if self.rank_method == "hybrid":
+            cur_rank_method = "margin" if len(max(
+                self.counts[pattern_size].values(), key=len)) < 3 else "counts"
+        else:
+            cur_rank_method = self.rank_method
+
+        if cur_rank_method == "margin":
+            cands = self.cand_patterns[pattern_size]
+            cand_patterns_uniq += canonical.dedupe([pattern for _, pattern
+                in sorted(cands, key=lambda x: x[0])],
+                node_anchored=self.node_anchored)[:self.out_batch_size]
+        elif cur_rank_method == "counts":
+            # split the wl hash buckets into isomorphism classes
+            groups = [group for neighs in self.counts[pattern_size].values()
+                for group in canonical.group_isomorphic(neighs,
+                node_anchored=self.node_anchored)]
+            for neighs in list(sorted(groups, key=len,
+                reverse=True))[:self.out_batch_size]:
+                cand_patterns_uniq.append(random.choice(neighs))
+        else:
+            print("Unrecognized rank method")
         return cand_patterns_uniq